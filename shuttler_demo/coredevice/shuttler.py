@@ -1,11 +1,26 @@
+import hashlib
+
+import numpy as np
 from numpy import int32, int64
 
 from artiq.language.core import delay_mu, kernel, delay, portable, at_mu, now_mu
+try:
+    from artiq.language.core import round64
+except ImportError:
+    # round64 is a kernel builtin; kernels interpreted on the host (see
+    # shuttler_demo.emulator) need it as a function.
+    @portable
+    def round64(x):
+        return int64(round(x))
 from artiq.language.units import us, ms, ns
-from artiq.language.types import TInt32, TFloat, TBool, TList
-from artiq.coredevice.rtio import rtio_output
+from artiq.language.types import TInt32, TInt64, TFloat, TBool, TList, TStr
+from artiq.coredevice.rtio import (rtio_output, rtio_output_wide,
+                                   rtio_input_data)
 
 from artiq.coredevice import spi2 as spi
+from artiq.coredevice.exceptions import RTIOUnderflow
+
+from shuttler_demo.waveforms import checksum, MU_PER_VOLT
 
 
 SPI_CONFIG = (0 * spi.SPI_OFFLINE | 0 * spi.SPI_END |
@@ -13,10 +28,91 @@ SPI_CONFIG = (0 * spi.SPI_OFFLINE | 0 * spi.SPI_END |
               1 * spi.SPI_CLK_POLARITY | 1 * spi.SPI_CLK_PHASE |
               0 * spi.SPI_LSB_FIRST | 0 * spi.SPI_HALF_DUPLEX)
 
-# SPI clock write and read dividers
-SPIT_CFG_WR = 16
+# Default SPI clock write and read dividers. Writes run at the AD9117 SCLK
+# maximum of 25 MHz (40 ns minimum period) with the 125 MHz RTIO clock.
+# Reads keep the slower clock they were checked with (warm_init relies on
+# them).
+SPIT_CFG_WR = 5
 SPIT_CFG_RD = 16
 
+# dac_write_seq and trigger mask selecting all DACs
+DAC_ALL = 0xFF
+# SPI register addresses per DAC covered by the shadow register map
+DAC_SHADOW_SIZE = 32
+
+# RTLINK registers, see shuttler_demo.gateware.cores.shuttler
+REG_SAMPLE = 0
+REG_ENABLE = 1
+REG_SAMPLES_PACKED = 2
+REG_WRITE_BASE = 3
+REG_SWAP = 4
+REG_START = 5
+REG_LENGTH = 6
+REG_REPEAT = 7
+REG_MODE = 8
+REG_NCO_FTW = 9
+REG_NCO_POW = 10
+REG_NCO_ASF = 11
+REG_SPLINE0 = 12
+REG_SPLINE1 = 13
+REG_SPLINE2 = 14
+REG_SPLINE3 = 15
+REG_SPLINE_DURATION = 16
+REG_CHECKSUM = 17
+REG_READBACK = 18
+REG_STREAM_WRITE = 19
+REG_STREAM_DATA = 20
+REG_STREAM_READ = 21
+REG_STREAM_RUN = 22
+REG_STREAM_STATUS = 23
+REG_TRIGGER = 24
+REG_SEGMENT = 25
+REG_PLAYLIST = 26
+REG_BANK = 27
+REG_WRITE_BANK = 28
+REG_GAIN = 29
+REG_OFFSET = 30
+REG_STATUS = 31
+
+# Memory writes, handled as events arrive rather than through the command
+# FIFO into the DAC clock domain, and input requests
+MEMORY_REGS = [REG_SAMPLE, REG_SAMPLES_PACKED, REG_WRITE_BASE,
+               REG_WRITE_BANK, REG_SEGMENT]
+STATUS_REGS = [REG_CHECKSUM, REG_READBACK, REG_STREAM_STATUS, REG_STATUS]
+
+MODE_TABLE = 0
+MODE_NCO = 1
+MODE_SPLINE = 2
+MODE_STREAM = 3
+# Flag for MODE_TABLE: two samples per DAC cycle (gateware built with ddr)
+MODE_DDR = 4
+
+STREAM_PLAYING = 1
+STREAM_UNDERRUN = 2
+# get_status() bits
+STATUS_CMD_OVERFLOW = 1
+STATUS_STREAM_OVERFLOW = 2
+
+# Playlist entries per DAC, and the next index ending a playlist
+PLAYLIST_DEPTH = 64
+PLAYLIST_END = 0xFF
+
+DAC_WIDTH = 14
+# Samples per packed write and packed writes per REG_WRITE_BASE window
+PACKED_SAMPLES = 4
+PACKED_WINDOW = 256
+# Fractional bits of the spline forward differences
+SPLINE_FRAC_WIDTH = 48
+SPLINE_SCALE = float(1 << SPLINE_FRAC_WIDTH)
+# RTIO cycles from set_spline() to the start of the segment: one per
+# forward difference write
+SPLINE_SETUP_CYCLES = 4
+# Output gain: signed, with 16 fractional bits, in [-2, 2)
+GAIN_WIDTH = 18
+GAIN_FRAC_WIDTH = 16
+# Output offset: signed machine units
+OFFSET_WIDTH = 16
+
 class Shuttler:
 
     dac_csn_mask = [
@@ -30,7 +126,18 @@ class Shuttler:
         0b1000
     ]
 
-    kernel_invariants = {"bus", "channel", "core", "dac_csn_mask"}
+    # DAC configuration applied by init() as a dac_write_seq sequence:
+    # on-chip IR_CML and QR_CML enabled
+    dac_config = [
+        DAC_ALL, 0x05, 1 << 7,
+        DAC_ALL, 0x08, 1 << 7
+    ]
+
+    kernel_invariants = {"bus", "channel", "core", "core_dma", "dac_csn_mask",
+                         "dac_config", "sample_rate", "spi_div_wr",
+                         "spi_div_rd", "upload_burst", "upload_slack_mu",
+                         "upload_retries", "rtio_fifo_depth",
+                         "stream_min_divider"}
 
     def __init__(self, 
                  dmgr, 
@@ -40,8 +147,19 @@ class Shuttler:
                  osc_en_device,
                  mmcx_sel_device,
                  refclk_sel_device,
-                 core_device="core"):
+                 core_device="core",
+                 core_dma_device="core_dma",
+                 sample_rate=125e6,
+                 spi_div_wr=SPIT_CFG_WR,
+                 spi_div_rd=SPIT_CFG_RD,
+                 upload_burst=32,
+                 upload_slack=20*us,
+                 upload_retries=1,
+                 rtio_fifo_depth=128,
+                 dma_spacing_cycles=16,
+                 stream_min_divider=1):
         self.core = dmgr.get(core_device)
+        self.core_dma = dmgr.get(core_dma_device)
         self.bus = dmgr.get(spi_device)
         self.channel = channel << 8
         self.dac_reset = dmgr.get(dac_reset_device)
@@ -50,70 +168,628 @@ class Shuttler:
         self.refclk_sel = dmgr.get(refclk_sel_device)
         self.ref_period_mu = self.core.seconds_to_mu(
             self.core.coarse_ref_period)
+        # DAC clock (clk0_m2c), sets the NCO frequency scale
+        self.sample_rate = sample_rate
+        self.spi_div_wr = spi_div_wr
+        self.spi_div_rd = spi_div_rd
+        self.wide_data = [int32(0), int32(0)]
+        # Names of DMA traces recorded by this driver
+        self.dma_traces = set()
+        # Last known DAC register values, DAC_SHADOW_SIZE per DAC, -1 when
+        # unknown
+        self.dac_shadow = [int32(-1)]*(8*DAC_SHADOW_SIZE)
+
+        # Bulk uploads: the gateware takes one event per RTIO cycle, so an
+        # upload starts with events one coarse cycle apart. The kernel CPU
+        # is usually slower, and once the RTIO FIFO is full the slack
+        # shrinks by the difference on every event. So every upload_burst
+        # events (keep it below the FIFO depth) the spacing is set to the
+        # CPU time per event measured over the last burst, and the
+        # timeline is pushed forward if the slack dropped below
+        # upload_slack. Slack beyond what the CPU submits in the time of a
+        # full RTIO FIFO (rtio_fifo_depth events) is waited out on the full
+        # FIFO, which also inflates the burst time. So the CPU time per
+        # event is the fastest burst of the upload, and the timeline is not
+        # pushed further than the FIFO spans at that rate. DMA recordings
+        # use dma_spacing_cycles instead.
+        self.upload_burst = upload_burst
+        self.upload_slack_mu = self.core.seconds_to_mu(upload_slack)
+        self.upload_retries = upload_retries
+        self.rtio_fifo_depth = rtio_fifo_depth
+        self.upload_spacing_mu = self.ref_period_mu
+        self.upload_counter_mu = int64(0)
+        self.upload_cpu_mu = int64(0)
+        self.dma_spacing_mu = dma_spacing_cycles*self.ref_period_mu
+        self.dma_recording = False
+        # Smallest slack seen before an upload burst, and uploads restarted
+        # after an RTIO underflow
+        self.min_slack_mu = int64(0x7FFFFFFFFFFFFFFF)
+        self.underflow_retries = 0
+
+        # SDRAM stream reads are pipelined over --shuttler-stream-ports
+        # native SDRAM ports, one read in flight on each, and stream_play
+        # rejects dividers below stream_min_divider. The default 10 ports
+        # sustain all eight DACs at full rate (divider 1) against the
+        # 16-cycle SDRAM model of shuttler_demo.gateware.bench; with fewer
+        # ports use about 10/ports. Check get_stream_status on the board.
+        self.stream_min_divider = stream_min_divider
 
 
     @kernel
-    def write(self, addr, value, enable=False):
+    def write(self, dac, reg, data):
         # RLINK LAYOUT:
         #   RTLINK ADDRESS -> 8 bits
-        #   RTLINK DATA -> 17 bits
-        #   
-        #   |   RTLINK ADDRESS [7:0]    |
-        #   |  ADDR [7:0] (addr & 0xFF) |
-        # 
-        #   |    RTLINK DATA [16:15]    |   RTLINK DATA[14]     |   RTLINK DATA [13:0]  |
-        #   |       ADDR [9:7]          |    Signal Enable      |           value       |
-
-        SE = 1 << 14
+        #   RTLINK DATA -> 32 bits (64 bits with write_wide)
+        #
+        #   |   RTLINK ADDRESS [7:3]    |   RTLINK ADDRESS [2:0]    |
+        #   |         REGISTER          |           DAC             |
+        #
+        # Every register is a single event: sample memory (MEMORY_REGS) and
+        # control writes do not carry each other's bits. REG_TRIGGER,
+        # REG_STATUS and the stream registers ignore DAC. The full map is
+        # in the "Register map" section of README.md; the most used ones
+        # are:
+        #
+        # REG_SAMPLE:
+        #   |    RTLINK DATA [31:14]    |   RTLINK DATA [13:0]  |
+        #   |      SAMPLE ADDRESS       |         value         |
+        #
+        # REG_ENABLE:
+        #   |    RTLINK DATA [0]    |
+        #   |    Signal Enable      |
+        #
+        # REG_WRITE_BASE:
+        #   |    RTLINK DATA [31:0]     |
+        #   | SAMPLE ADDRESS (4n)       |
+        #
+        # REG_SWAP: data ignored
+        #
+        # REG_START, REG_LENGTH, REG_REPEAT, REG_MODE, REG_NCO_*, REG_BANK,
+        # REG_WRITE_BANK, REG_GAIN, REG_OFFSET:
+        #   |    RTLINK DATA [31:0]     |
+        #   |          value            |
+        #
+        # REG_SPLINE0..3 (64-bit RTLINK DATA, see write_wide):
+        #   |    RTLINK DATA [63:0]     |
+        #   | forward difference, Q16.48 |
+        #
+        # REG_SPLINE_DURATION:
+        #   |    RTLINK DATA [31:0]     |
+        #   |    duration (dac cycles)  |
+        #
+        # REG_STATUS (input request, see get_status):
+        #   |    RTLINK DATA [0]    |
+        #   |        clear          |
 
-        value |= SE
+        rtio_output(self.channel | reg << 3 | dac, data)
 
-        DAC_WIDTH = 14
-        
-        value &= (1 << DAC_WIDTH + 1) - 1
-        value |= (addr >> 8) << (DAC_WIDTH + 1)
-        addr = addr & 0xFF
-        
-        
-        rtio_output(self.channel | addr, value)
 
+    @kernel
+    def write_wide(self, dac, reg, data: TInt64):
+        self.wide_data[0] = int32(data)
+        self.wide_data[1] = int32(data >> 32)
+        rtio_output_wide(self.channel | reg << 3 | dac, self.wide_data)
 
     @kernel
-    def set_enable(self, enable):
-        self.write(0, 0, True)
+    def set_enable(self, dac, enable):
+        self.write(dac, REG_ENABLE, 1 if enable else 0)
     
     
     @kernel
-    def write_sample(self, n_sample, value):
-        self.write(n_sample, value)
+    def trigger(self, start_mask, stop_mask=0):
+        # Enables the DACs in start_mask and disables those in stop_mask
+        # (bit i selects DAC i) in the same dac cycle, a fixed latency after
+        # the event. DACs already playing restart from the loop start, so
+        # this also realigns running waveforms. Keep triggers 4 RTIO cycles
+        # apart.
+        self.write(0, REG_TRIGGER, (stop_mask & 0xFF) << 8 | start_mask & 0xFF)
+
+    @kernel
+    def swap(self, dac):
+        # Sample writes always land in the shadow bank. Swapping makes it
+        # the active bank at the next loop wrap (at once if the DAC is
+        # disabled). Subsequent writes go to the bank that was playing, so
+        # wait for the wrap before uploading the next waveform.
+        self.write(dac, REG_SWAP, 0)
+
+    @kernel
+    def select_bank(self, dac, bank):
+        # Plays bank from the next loop wrap (at once if the DAC is
+        # disabled), like swap but leaving the write bank alone, so that a
+        # single event switches between waveforms preloaded into the banks
+        self.write(dac, REG_BANK, bank)
+
+    @kernel
+    def set_write_bank(self, dac, bank):
+        # Bank further sample writes, checksums and readback refer to.
+        # Write the bank that is playing only if glitches are acceptable.
+        self.write(dac, REG_WRITE_BANK, bank)
+
+    @kernel
+    def set_start(self, dac, start):
+        # First sample of the loop, applied at the next loop wrap
+        self.write(dac, REG_START, start)
+
+    @kernel
+    def set_length(self, dac, length):
+        # Samples per loop (0 = whole bank), applied at the next loop wrap
+        self.write(dac, REG_LENGTH, length)
+
+    @kernel
+    def set_repeat(self, dac, repeat):
+        # Number of loops (0 = forever), applied when playback starts. The
+        # last sample is held once all loops have been played.
+        self.write(dac, REG_REPEAT, repeat)
+
+    @kernel
+    def write_segment(self, dac, index, start, length, repeat=1,
+                      next_index=PLAYLIST_END):
+        # Playlist entry: length samples (0 = whole bank) from start,
+        # played repeat times (0 = until stopped), followed by entry
+        # next_index. PLAYLIST_END ends the playlist, holding the last
+        # sample. Do not rewrite entries of a running playlist.
+        self.write_wide(dac, REG_SEGMENT,
+                        int64(index & 0xFF) << 56 |
+                        int64(next_index & 0xFF) << 48 |
+                        int64(repeat & 0xFFFF) << 32 |
+                        int64(length & 0xFFFF) << 16 |
+                        int64(start & 0xFFFF))
+
+    @kernel
+    def set_playlist(self, dac, first, enable=True):
+        # With enable, playback (set_enable, trigger) runs the playlist
+        # from entry first instead of the loop registers. The segments run
+        # back to back without any further event.
+        on = 0
+        if enable:
+            on = 1 << 8
+        self.write(dac, REG_PLAYLIST, on | first & 0xFF)
+
+    @kernel
+    def load_playlist(self, dac, segments: TList(TInt32), first=0):
+        # Writes segments, flattened (start, length, repeat) triples, to
+        # consecutive entries from first, chained in order, and selects the
+        # playlist. A single set_enable or trigger then plays it all.
+        n = len(segments) // 3
+        self.start_upload()
+        for i in range(n):
+            next_index = first + i + 1
+            if i == n - 1:
+                next_index = PLAYLIST_END
+            self.write_segment(dac, first + i, segments[3*i],
+                               segments[3*i + 1], segments[3*i + 2],
+                               next_index)
+            self.upload_step(i)
+        self.set_playlist(dac, first)
+
+    @kernel
+    def set_mode(self, dac, mode):
+        # MODE_TABLE plays the sample memory, MODE_NCO the on-chip sine,
+        # MODE_SPLINE the spline generator and MODE_STREAM the SDRAM stream.
+        # MODE_TABLE | MODE_DDR plays two consecutive samples per DAC cycle,
+        # one per clock edge, from even start and length.
+        self.write(dac, REG_MODE, mode)
+
+    @portable
+    def frequency_to_ftw(self, frequency: TFloat) -> TInt32:
+        # The phase accumulator wraps, so the FTW is taken modulo 2**32:
+        # sample_rate/2 and above alias to negative frequencies
+        ftw = (round64(frequency*(1 << 32)/self.sample_rate) &
+               int64(0xFFFFFFFF))
+        if ftw >= int64(1) << 31:
+            ftw -= int64(1) << 32
+        return int32(ftw)
+
+    @portable
+    def turns_to_pow(self, turns: TFloat) -> TInt32:
+        return int32(round(turns*(1 << 16))) & 0xFFFF
+
+    @portable
+    def amplitude_to_asf(self, amplitude: TFloat) -> TInt32:
+        asf = int32(round(amplitude*((1 << DAC_WIDTH) - 1)))
+        if asf < 0:
+            asf = 0
+        if asf > (1 << DAC_WIDTH) - 1:
+            asf = (1 << DAC_WIDTH) - 1
+        return asf
+
+    @kernel
+    def set_nco_frequency(self, dac, frequency: TFloat):
+        # Resolution is sample_rate/2**32 (~29 mHz at 125 MHz)
+        self.write(dac, REG_NCO_FTW, self.frequency_to_ftw(frequency))
+
+    @kernel
+    def set_nco_phase(self, dac, turns: TFloat):
+        self.write(dac, REG_NCO_POW, self.turns_to_pow(turns))
+
+    @kernel
+    def set_nco_amplitude(self, dac, amplitude: TFloat):
+        # Fraction of full scale around midscale
+        self.write(dac, REG_NCO_ASF, self.amplitude_to_asf(amplitude))
+
+    @portable
+    def gain_to_mu(self, gain: TFloat) -> TInt32:
+        limit = 1 << (GAIN_WIDTH - 1)
+        mu = int32(round(gain*(1 << GAIN_FRAC_WIDTH)))
+        if mu < -limit:
+            mu = -limit
+        if mu > limit - 1:
+            mu = limit - 1
+        return mu & ((1 << GAIN_WIDTH) - 1)
+
+    @portable
+    def offset_to_mu(self, offset: TFloat) -> TInt32:
+        limit = 1 << (OFFSET_WIDTH - 1)
+        mu = int32(round(offset*MU_PER_VOLT))
+        if mu < -limit:
+            mu = -limit
+        if mu > limit - 1:
+            mu = limit - 1
+        return mu & ((1 << OFFSET_WIDTH) - 1)
+
+    @kernel
+    def set_gain(self, dac, gain: TFloat):
+        # Scales the output of every mode around midscale, in [-2, 2), a
+        # few DAC cycles after the event. Samples need not be re-uploaded
+        # to change the amplitude.
+        self.write(dac, REG_GAIN, self.gain_to_mu(gain))
+
+    @kernel
+    def set_offset(self, dac, offset: TFloat):
+        # Output offset in volts, added after the gain. The output
+        # saturates at the ends of the DAC range.
+        self.write(dac, REG_OFFSET, self.offset_to_mu(offset))
+
+    @kernel
+    def write_packed_words(self, dac, words: TList(TInt32)):
+        # Uploads samples already packed on the host (see
+        # shuttler_demo.waveforms.pack_samples): words holds [low, high]
+        # halves of consecutive REG_SAMPLES_PACKED words, starting at
+        # sample 0.
+        for attempt in range(self.upload_retries):
+            try:
+                self._write_packed_words(dac, words)
+                return
+            except RTIOUnderflow:
+                self.retry_upload(dac)
+        self._write_packed_words(dac, words)
+
+    @kernel
+    def _write_packed_words(self, dac, words: TList(TInt32)):
+        self.start_upload()
+        for i in range(len(words) // 2):
+            if i % PACKED_WINDOW == 0:
+                self.write(dac, REG_WRITE_BASE, i*PACKED_SAMPLES)
+                delay_mu(self.ref_period_mu)
+            self.wide_data[0] = words[2*i]
+            self.wide_data[1] = words[2*i + 1]
+            rtio_output_wide(self.channel | REG_SAMPLES_PACKED << 3 | dac,
+                             self.wide_data)
+            self.upload_step(i)
+
+    @kernel
+    def set_spline(self, dac, coeffs: TList(TFloat), duration_mu: TInt64):
+        # Plays v(t) = c0 + c1*t + c2*t**2 + c3*t**3, with v in DAC machine
+        # units and t in DAC sample periods, for duration_mu. The DAC then
+        # holds v(duration). MODE_SPLINE must be selected for it to reach
+        # the output.
+        #
+        # The hardware integrates forward differences: they are written in
+        # the SPLINE_SETUP_CYCLES RTIO cycles from now_mu() on, and the
+        # duration write starts the segment SPLINE_SETUP_CYCLES cycles after
+        # now_mu(). The timeline is advanced past the duration write, by
+        # SPLINE_SETUP_CYCLES + 1 RTIO cycles.
+        c0 = coeffs[0]
+        c1 = coeffs[1]
+        c2 = coeffs[2]
+        c3 = coeffs[3]
+        diffs = [c0, c1 + c2 + c3, 2.*c2 + 6.*c3, 6.*c3]
+        for i in range(SPLINE_SETUP_CYCLES):
+            self.write_wide(dac, REG_SPLINE0 + i,
+                            int64(round64(diffs[i]*SPLINE_SCALE)))
+            delay_mu(self.ref_period_mu)
+        cycles = int32(round(self.core.mu_to_seconds(duration_mu) *
+                             self.sample_rate))
+        self.write(dac, REG_SPLINE_DURATION, cycles)
+        delay_mu(self.ref_period_mu)
+
+    @kernel
+    def write_sample(self, dac, n_sample, value):
+        value &= (1 << DAC_WIDTH) - 1
+        self.write(dac, REG_SAMPLE, n_sample << DAC_WIDTH | value)
         
     
     @kernel
-    def write_samples(self, data: TList(TInt32)):
-        for i in range (len(data)):
-            self.write(i, data[i])
-            delay_mu(100*self.ref_period_mu)
+    def check_upload_slack(self, counter: TInt64, margin: TInt64):
+        slack = now_mu() - counter
+        if slack < self.min_slack_mu:
+            self.min_slack_mu = slack
+        if slack < margin:
+            # The CPU is catching up with the timeline: continue the upload
+            # later rather than underflow
+            at_mu(counter + margin)
+
+    @kernel
+    def start_upload(self):
+        if self.dma_recording:
+            return
+        self.upload_spacing_mu = self.ref_period_mu
+        self.upload_counter_mu = self.core.get_rtio_counter_mu()
+        self.upload_cpu_mu = int64(0x7FFFFFFFFFFFFFFF)
+        self.check_upload_slack(self.upload_counter_mu,
+                                self.upload_slack_mu)
+
+    @kernel
+    def adapt_upload(self):
+        # Matches the event spacing to the CPU time per event, in whole
+        # coarse cycles rounded down: the slack then shrinks slightly and
+        # is topped up to at most what the FIFO spans
+        counter = self.core.get_rtio_counter_mu()
+        per_event = ((counter - self.upload_counter_mu) //
+                     int64(self.upload_burst))
+        if per_event < self.upload_cpu_mu:
+            self.upload_cpu_mu = per_event
+        cycles = self.upload_cpu_mu//self.ref_period_mu
+        self.upload_spacing_mu = max(cycles, int64(1))*self.ref_period_mu
+        self.upload_counter_mu = counter
+        self.check_upload_slack(counter, min(
+            self.upload_slack_mu,
+            int64(self.rtio_fifo_depth)*self.upload_cpu_mu))
+
+    @kernel
+    def upload_step(self, i):
+        # Spacing after upload event i, adapted between bursts
+        if self.dma_recording:
+            delay_mu(self.dma_spacing_mu)
+        else:
+            delay_mu(self.upload_spacing_mu)
+            if i % self.upload_burst == self.upload_burst - 1:
+                self.adapt_upload()
+
+    @kernel
+    def retry_upload(self, dac):
+        # An upload underflowed: it is resent from the start on a fresh
+        # timeline. Samples already written would be counted twice by
+        # REG_CHECKSUM, so the checksum restarts with the resent upload.
+        self.underflow_retries += 1
+        self.core.break_realtime()
+        self.read_checksum(dac, True)
+        self.core.break_realtime()
+
+    @kernel
+    def write_samples(self, dac, data: TList(TInt32)):
+        for attempt in range(self.upload_retries):
+            try:
+                self._write_samples(dac, data)
+                return
+            except RTIOUnderflow:
+                self.retry_upload(dac)
+        self._write_samples(dac, data)
+
+    @kernel
+    def _write_samples(self, dac, data: TList(TInt32)):
+        self.start_upload()
+        for i in range(len(data)):
+            self.write_sample(dac, i, data[i])
+            self.upload_step(i)
+
+    @kernel
+    def write_packed(self, dac, offset, s0, s1, s2, s3):
+        # REG_SAMPLES_PACKED (64-bit RTLINK DATA):
+        #   |  [63:56]  | [55:42] | [41:28] | [27:14] | [13:0] |
+        #   |  OFFSET   |   s3    |   s2    |   s1    |   s0   |
+        #
+        # s0 is stored at REG_WRITE_BASE + 4*OFFSET.
+        mask = (1 << DAC_WIDTH) - 1
+        word = (int64(s0 & mask) |
+                int64(s1 & mask) << DAC_WIDTH |
+                int64(s2 & mask) << 2*DAC_WIDTH |
+                int64(s3 & mask) << 3*DAC_WIDTH |
+                int64(offset) << 4*DAC_WIDTH)
+        self.write_wide(dac, REG_SAMPLES_PACKED, word)
+
+    @kernel
+    def write_samples_packed(self, dac, data: TList(TInt32)):
+        for attempt in range(self.upload_retries):
+            try:
+                self._write_samples_packed(dac, data)
+                return
+            except RTIOUnderflow:
+                self.retry_upload(dac)
+        self._write_samples_packed(dac, data)
+
+    @kernel
+    def _write_samples_packed(self, dac, data: TList(TInt32)):
+        self.start_upload()
+        n = len(data)
+        n_packed = n - n % PACKED_SAMPLES
+        for i in range(0, n_packed, PACKED_SAMPLES):
+            offset = (i // PACKED_SAMPLES) % PACKED_WINDOW
+            if offset == 0:
+                self.write(dac, REG_WRITE_BASE, i)
+                delay_mu(self.ref_period_mu)
+            self.write_packed(dac, offset,
+                              data[i], data[i+1], data[i+2], data[i+3])
+            self.upload_step(i // PACKED_SAMPLES)
+        for i in range(n_packed, n):
+            self.write_sample(dac, i, data[i])
+            self.upload_step(i)
+
+    @kernel
+    def read_checksum(self, dac, clear: TBool = False) -> TInt32:
+        # CRC-32 of the samples written to the DAC since the last clear
+        # (see shuttler_demo.waveforms.checksum), cleared afterwards if
+        # clear. Blocks until the reply arrives, so the timeline is left
+        # behind the wall clock.
+        self.write(dac, REG_CHECKSUM, 1 if clear else 0)
+        return rtio_input_data(self.channel >> 8)
+
+    @kernel
+    def read_sample(self, dac, n_sample) -> TInt32:
+        # Sample n_sample of the write bank (the one uploads go to)
+        self.write(dac, REG_READBACK, n_sample << DAC_WIDTH)
+        return rtio_input_data(self.channel >> 8)
+
+    def checksum(self, data) -> TInt32:
+        # Signed, to compare with the 32-bit RTIO input data
+        crc = checksum(data)
+        return int32(crc - (1 << 32) if crc >= 1 << 31 else crc)
+
+    @kernel
+    def verify(self, dac, data: TList(TInt32)) -> TBool:
+        # Checks that the samples written since the last clear are exactly
+        # data, and clears the checksum for the next upload. Call
+        # read_checksum(dac, True) before uploading to start from a clean
+        # state.
+        expected = self.checksum(data)
+        return self.read_checksum(dac, True) == expected
+
+    @kernel
+    def write_stream_words(self, word, words: TList(TInt32)):
+        # Writes a stream packed on the host (see
+        # shuttler_demo.waveforms.pack_stream) to SDRAM from stream word
+        # `word` on. Requires a gateware built with SDRAM streaming.
+        self.start_upload()
+        self.write(0, REG_STREAM_WRITE, word)
+        delay_mu(self.ref_period_mu)
+        for i in range(len(words) // 2):
+            self.wide_data[0] = words[2*i]
+            self.wide_data[1] = words[2*i + 1]
+            rtio_output_wide(self.channel | REG_STREAM_DATA << 3,
+                             self.wide_data)
+            self.upload_step(i)
+
+    @kernel
+    def stream_play(self, word, length, divider=0):
+        # Plays `length` stream words from `word` on all DACs in
+        # MODE_STREAM, a sample each every `divider` DAC cycles, by default
+        # stream_min_divider, the fastest rate the SDRAM reader sustains.
+        # Playback starts once the prefetch FIFO is full, so the start is
+        # not aligned to now_mu(). The last sample is held at the end.
+        if divider == 0:
+            divider = self.stream_min_divider
+        if divider < self.stream_min_divider:
+            raise ValueError("Stream divider below stream_min_divider")
+        self.write_wide(0, REG_STREAM_READ, int64(length) << 32 | int64(word))
+        delay_mu(self.ref_period_mu)
+        self.write(0, REG_STREAM_RUN, divider << 16 | 1)
+
+    @kernel
+    def stream_stop(self):
+        self.write(0, REG_STREAM_RUN, 0)
+
+    @kernel
+    def get_stream_status(self) -> TInt32:
+        # STREAM_PLAYING while samples are being played, STREAM_UNDERRUN
+        # if SDRAM fell behind since the stream started. Blocks until the
+        # reply arrives.
+        self.write(0, REG_STREAM_STATUS, 0)
+        return rtio_input_data(self.channel >> 8)
+
+    @kernel
+    def get_status(self, clear: TBool = False) -> TInt32:
+        # STATUS_CMD_OVERFLOW if a control event was dropped because the
+        # command FIFO into the DAC clock domain was full, which happens
+        # when control events outpace the DAC clock, STATUS_STREAM_OVERFLOW
+        # likewise for stream events (write_stream_words faster than the
+        # stream reader takes them). The bits stay set until read with
+        # clear. Blocks until the reply arrives.
+        self.write(0, REG_STATUS, 1 if clear else 0)
+        return rtio_input_data(self.channel >> 8)
+
+    def dma_trace_name(self, dac, data) -> TStr:
+        # Content addressed: the same waveform on the same DAC always maps
+        # to the same trace, so it only has to be recorded once. Call it on
+        # the host and pass the name to the kernel, hashing in the kernel
+        # would send the whole waveform back over RPC.
+        digest = hashlib.sha1(np.asarray(data, dtype=np.int32).tobytes())
+        return "shuttler{}_dac{}_{}".format(
+            self.channel >> 8, dac, digest.hexdigest())
+
+    def dma_trace_recorded(self, name) -> TBool:
+        # Test-and-set: the caller records the trace when this returns False.
+        if name in self.dma_traces:
+            return True
+        self.dma_traces.add(name)
+        return False
+
+    @kernel
+    def record_samples(self, name: TStr, dac, data: TList(TInt32)):
+        # Records the upload of data to dac as DMA trace name, from
+        # dma_trace_name(dac, data), unless it was recorded before.
+        if not self.dma_trace_recorded(name):
+            self.dma_recording = True
+            with self.core_dma.record(name):
+                self.write_samples_packed(dac, data)
+            self.dma_recording = False
+
+    @kernel
+    def get_samples_handle(self, name: TStr):
+        # Recording any trace invalidates handles obtained before, so record
+        # all waveforms first and fetch their handles afterwards, before the
+        # realtime section.
+        return self.core_dma.get_handle(name)
+
+    @kernel
+    def playback_samples(self, handle):
+        # Replays a handle from get_samples_handle without any RPC.
+        self.core_dma.playback_handle(handle)
 
     @kernel
     def dac_write(self, dac: TInt32, adr: TInt32, dat: TInt32):
         dac_mask = self.dac_csn_mask[dac]
 
         self.bus.set_config_mu(SPI_CONFIG | spi.SPI_END, 16,
-                               SPIT_CFG_WR, dac_mask)
+                               self.spi_div_wr, dac_mask)
         cmd = 0b0 << 7 | 0b00 << 5 | adr
         self.bus.write(cmd << 24 | dat << 16)
+        self.dac_shadow[dac*DAC_SHADOW_SIZE + (adr & 0x1F)] = dat & 0xFF
+
+    @kernel
+    def dac_write_seq(self, ops: TList(TInt32), only_changed: TBool = False):
+        # Register write sequence, flattened (dac_mask, adr, dat) triples.
+        # Bit i of dac_mask selects DAC i, DAC_ALL broadcasts. With
+        # only_changed, writes of the value already in the shadow register
+        # map are skipped. Returns the number of writes issued.
+        #
+        # The chip select decoder enables one DAC at a time, so a broadcast
+        # is still one transfer per DAC. All writes to a DAC are issued
+        # back to back, in sequence order, behind a single SPI
+        # configuration; the DACs are independent, so only the order
+        # within each DAC matters.
+        cmd_mask = (1 << 5) - 1
+        n = 0
+        for dac in range(8):
+            configured = False
+            for i in range(0, len(ops), 3):
+                if not ops[i] & (1 << dac):
+                    continue
+                cmd = ops[i + 1] & cmd_mask
+                dat = ops[i + 2] & 0xFF
+                shadow = dac*DAC_SHADOW_SIZE + cmd
+                if only_changed and self.dac_shadow[shadow] == dat:
+                    continue
+                if not configured:
+                    self.bus.set_config_mu(SPI_CONFIG | spi.SPI_END, 16,
+                                           self.spi_div_wr,
+                                           self.dac_csn_mask[dac])
+                    configured = True
+                self.bus.write(cmd << 24 | dat << 16)
+                self.dac_shadow[shadow] = dat
+                n += 1
+        return n
 
     @kernel
     def dac_read(self, dac: TInt32, adr: TInt32):
         dac_mask = self.dac_csn_mask[dac]
 
         self.bus.set_config_mu(SPI_CONFIG, 8,
-                               SPIT_CFG_WR, 1 << 3 | dac_mask)
+                               self.spi_div_rd, 1 << 3 | dac_mask)
         cmd = 0b1 << 7 | 0b00 << 5 | adr
         self.bus.write(cmd << 24)
 
         self.bus.set_config_mu(SPI_CONFIG | spi.SPI_END | spi.SPI_INPUT | spi.SPI_HALF_DUPLEX, 8,
-                               SPIT_CFG_WR, dac_mask)
+                               self.spi_div_rd, dac_mask)
         self.bus.write(cmd << 24)
         return self.bus.read()
 
@@ -122,6 +798,8 @@ class Shuttler:
         self.dac_reset.on()
         delay(100*ns)
         self.dac_reset.off()
+        for i in range(len(self.dac_shadow)):
+            self.dac_shadow[i] = -1
 
     @kernel
     def init(self):
@@ -132,13 +810,42 @@ class Shuttler:
         for i in range(8):
             assert self.dac_read(i, 0x1F) == 0x0A
             delay(10*us)
-            self.dac_write(i, 0x5, 1 << 7)
-            self.dac_write(i, 0x8, 1 << 7)
+        self.dac_write_seq(self.dac_config)
 
         self.osc_en.on()
         self.mmcx_sel.on()
         self.refclk_sel.on()        
 
+    @kernel
+    def warm_init(self) -> TInt32:
+        # Brings the card to the init() state without resetting the DACs,
+        # for back-to-back experiments on a card initialized since power-up.
+        # The dac_config registers are read back into the shadow and only
+        # those that differ are rewritten; the DAC ID is checked only then.
+        # The clock selection outputs are re-asserted, so no settling time
+        # is needed if they were already on. Returns the number of
+        # registers rewritten.
+        for i in range(8):
+            stale = False
+            for j in range(0, len(self.dac_config), 3):
+                if not self.dac_config[j] & (1 << i):
+                    continue
+                adr = self.dac_config[j + 1]
+                value = self.dac_read(i, adr) & 0xFF
+                delay(10*us)
+                self.dac_shadow[i*DAC_SHADOW_SIZE + adr] = value
+                if value != self.dac_config[j + 2]:
+                    stale = True
+            if stale:
+                assert self.dac_read(i, 0x1F) == 0x0A
+                delay(10*us)
+        n = self.dac_write_seq(self.dac_config, True)
+
+        self.osc_en.on()
+        self.mmcx_sel.on()
+        self.refclk_sel.on()
+        return n
+
     @kernel
     def get_dac_timing_status(self, dac):
         return self.dac_read(dac, 0x14)
@@ -0,0 +1,710 @@
+"""Offline emulator of the Shuttler RTIO channel.
+
+Runs experiments and the :class:`shuttler_demo.coredevice.shuttler.Shuttler`
+driver on the host, without a board. Kernels are interpreted as Python;
+RTIO events emitted by the driver are intercepted, timed against a model
+of the core device, and decoded into the state of the gateware (sample
+banks, write pointers, registers, playlists, upload checksums, SDRAM
+stream)::
+
+    emu = ShuttlerEmulator()
+    with emu:
+        emu.shuttler.init()
+        with emu.measure() as span:
+            emu.shuttler.write_samples_packed(0, samples)
+    print(span.cpu_mu, span.timeline_mu, emu.min_slack_mu)
+
+Timing model: every event costs the CPU `event_cost_mu` (DMA playback
+`dma_event_cost_mu`), and a submission stalls until the event `fifo_depth`
+places earlier has left the FIFO, i.e. the RTIO counter has reached its
+timestamp. An event whose timestamp is behind the counter when submitted
+underflows. Events are buffered and processed in vectorized batches at
+synchronization points (kernel exit, input reads, counter reads, resets).
+Large batches, e.g. from `submit` or DMA, are decoded at about a million
+sample writes per second and several million control events per second.
+Driver uploads are interpreted as Python and read the RTIO counter every
+`upload_burst` events, so they are slower, at several ten thousand events
+per second (see `shuttler_demo.emulator_bench`).
+
+Loop playback, NCO, spline and stream outputs are not emulated: registers
+are recorded, not played, and the stream status and REG_STATUS always
+read 0.
+"""
+
+import zlib
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+from artiq.language import core as core_language
+from artiq.coredevice.exceptions import RTIOUnderflow
+from artiq.coredevice import spi2 as spi
+
+from shuttler_demo.coredevice import shuttler as driver
+from shuttler_demo.coredevice.shuttler import (
+    Shuttler, REG_SAMPLE, REG_SAMPLES_PACKED, REG_WRITE_BASE, REG_SWAP,
+    REG_LENGTH, REG_NCO_ASF, REG_CHECKSUM, REG_STREAM_WRITE,
+    REG_STREAM_DATA, REG_STREAM_STATUS, REG_TRIGGER, REG_ENABLE, REG_SEGMENT,
+    REG_PLAYLIST, REG_BANK, REG_WRITE_BANK, REG_STATUS, DAC_WIDTH,
+    PACKED_SAMPLES, PLAYLIST_DEPTH, MEMORY_REGS, STATUS_REGS)
+from shuttler_demo.waveforms import STREAM_LANE_WIDTH, STREAM_WORD_WIDTH
+
+
+# core.reset() and core.break_realtime() margin, as on the core device
+RESET_SLACK_MU = 125000
+# AD9117 ID register value
+DAC_ID = 0x0A
+# Register classes, indexed by register number
+_STATUS = np.isin(np.arange(32), STATUS_REGS)
+_MEMORY = np.isin(np.arange(32), MEMORY_REGS)
+
+
+class _TimeManager:
+    # Sequential and parallel timeline contexts, as artiq.sim.time
+    def __init__(self, ref_period):
+        self.ref_period = ref_period
+        self.now = 0
+        # Parallel blocks: [start, end] of each enclosing one
+        self.stack = []
+
+    def enter_sequential(self):
+        self.stack.append(None)
+
+    def enter_parallel(self):
+        self.stack.append([self.now, self.now])
+
+    def exit(self):
+        block = self.stack.pop()
+        if block is not None:
+            self.now = max(block[1], self.now)
+
+    def take_time_mu(self, duration):
+        self.now += int(duration)
+        if self.stack and self.stack[-1] is not None:
+            # Statements of a parallel block all start at its start
+            block = self.stack[-1]
+            block[1] = max(block[1], self.now)
+            self.now = block[0]
+
+    def get_time_mu(self):
+        return self.now
+
+    def set_time_mu(self, t):
+        self.take_time_mu(int(t) - self.now)
+
+    def take_time(self, duration):
+        self.take_time_mu(round(duration/self.ref_period))
+
+
+class EmulatorCore:
+    """Stand-in for `artiq.coredevice.core.Core`."""
+    def __init__(self, emulator, ref_period=1e-9, ref_multiplier=8):
+        self.emulator = emulator
+        self.ref_period = ref_period
+        self.ref_multiplier = ref_multiplier
+        self.coarse_ref_period = ref_period*ref_multiplier
+        self.core = self
+        self._level = 0
+
+    def run(self, k_function, k_args, k_kwargs):
+        self._level += 1
+        try:
+            result = k_function.artiq_embedded.function(*k_args, **k_kwargs)
+        finally:
+            self._level -= 1
+        if self._level == 0:
+            self.emulator.flush()
+        return result
+
+    def seconds_to_mu(self, seconds):
+        return np.int64(round(seconds/self.ref_period))
+
+    def mu_to_seconds(self, mu):
+        return mu*self.ref_period
+
+    def reset(self):
+        self.emulator.reset()
+
+    def break_realtime(self):
+        emu = self.emulator
+        emu.flush()
+        min_now = emu.cpu_mu + RESET_SLACK_MU
+        if emu.time.now < min_now:
+            emu.time.now = min_now
+
+    def get_rtio_counter_mu(self):
+        self.emulator.flush()
+        return np.int64(self.emulator.cpu_mu)
+
+    def wait_until_mu(self, cursor_mu):
+        emu = self.emulator
+        emu.flush()
+        emu.cpu_mu = max(emu.cpu_mu, int(cursor_mu))
+
+
+class _DMARecord:
+    def __init__(self, dma, name):
+        self.dma = dma
+        self.name = name
+
+    def __enter__(self):
+        emu = self.dma.emulator
+        self.saved_now = emu.time.now
+        emu.time.now = 0
+        emu._recording = ([], [], [])
+
+    def __exit__(self, *exc):
+        emu = self.dma.emulator
+        t, target, data = emu._recording
+        emu._recording = None
+        self.dma.traces[self.name] = (
+            emu.time.now, np.array(t, dtype=np.int64),
+            np.array(target, dtype=np.int64),
+            np.array(data, dtype=np.uint64))
+        emu.time.now = self.saved_now
+
+
+class EmulatorDMA:
+    """Stand-in for `artiq.coredevice.dma.CoreDMA`."""
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.traces = {}
+
+    def record(self, name):
+        return _DMARecord(self, name)
+
+    def erase(self, name):
+        del self.traces[name]
+
+    def get_handle(self, name):
+        return (self.traces[name][0], name)
+
+    def playback_handle(self, handle):
+        duration, name = handle
+        emu = self.emulator
+        _, t, target, data = self.traces[name]
+        emu.submit(emu.time.now + t, target, data, emu.dma_event_cost_mu)
+        emu.time.take_time_mu(duration)
+
+    def playback(self, name):
+        self.playback_handle(self.get_handle(name))
+
+
+class _TTLOut:
+    def __init__(self, emulator, channel, on_set=None):
+        self.emulator = emulator
+        self.channel = channel
+        self.target_o = channel << 8
+        self.on_set = on_set
+        self.state = False
+
+    def set_o(self, o):
+        self.state = bool(o)
+        self.emulator.output(self.target_o, int(o))
+        if o and self.on_set is not None:
+            self.on_set()
+
+    def on(self):
+        self.set_o(True)
+
+    def off(self):
+        self.set_o(False)
+
+    def pulse(self, duration):
+        self.on()
+        core_language.delay(duration)
+        self.off()
+
+
+class _SPIBus:
+    # SPI master in front of the AD9117 register files. Chip selects are
+    # decoded with Shuttler.dac_csn_mask.
+    def __init__(self, emulator, channel):
+        self.emulator = emulator
+        self.channel = channel
+        self.target = channel << 8
+        self.ref_period_mu = 8
+        self.xfer_duration_mu = 0
+        self.flags = 0
+        self.dac = None
+        self.read_adr = None
+        self.registers = [dict() for _ in range(8)]
+
+    def reset(self):
+        for regs in self.registers:
+            regs.clear()
+
+    def set_config_mu(self, flags, length, div, cs):
+        self.flags = flags
+        self.xfer_duration_mu = (length + 1)*div*self.ref_period_mu
+        self.dac = (Shuttler.dac_csn_mask.index(cs)
+                    if cs in Shuttler.dac_csn_mask else None)
+        self.emulator.output(self.target | 1, flags)
+        core_language.delay_mu(self.ref_period_mu)
+
+    def write(self, data):
+        emu = self.emulator
+        emu.output(self.target, data)
+        cmd = (int(data) >> 24) & 0xFF
+        if self.dac is not None:
+            regs = self.registers[self.dac]
+            if self.flags & spi.SPI_INPUT:
+                value = DAC_ID if self.read_adr == 0x1F else \
+                    regs.get(self.read_adr, 0)
+                emu.queue_input(self.channel,
+                                emu.time.now + self.xfer_duration_mu, value)
+            elif cmd & 0x80:
+                self.read_adr = cmd & 0x1F
+            else:
+                regs[cmd & 0x1F] = (int(data) >> 16) & 0xFF
+        core_language.delay_mu(self.xfer_duration_mu)
+
+    def read(self):
+        return self.emulator.input(self.channel)
+
+
+class _DeviceManager:
+    def __init__(self, devices):
+        self.devices = devices
+
+    def get(self, name):
+        return self.devices[name]
+
+
+class _Span:
+    cpu_mu = 0
+    timeline_mu = 0
+    events = 0
+    stall_mu = 0
+    underflows = 0
+
+
+class ShuttlerEmulator:
+    """Host-side Shuttler card with a core device timing model.
+
+    Inside a `with` block, kernels run as Python against this emulator:
+    the ARTIQ time manager is installed and the driver's RTIO syscalls are
+    redirected here. `shuttler`, `core` and `core_dma` are the devices to
+    use in experiments.
+
+    :param n_samples: samples per bank, as the gateware.
+    :param n_banks: sample banks per DAC, as the gateware.
+    :param n_dacs: DAC channels.
+    :param channel: RTIO channel of the Shuttler samples PHY.
+    :param fifo_depth: RTIO events in flight before submission stalls.
+    :param event_cost_mu: CPU time per event submitted by a kernel.
+    :param dma_event_cost_mu: time per event played back by DMA.
+    :param input_latency_mu: from an input request event to its reply.
+    :param strict: raise `RTIOUnderflow` at the first underflow (events
+        from it on are dropped). Otherwise underflows are only counted.
+    """
+    def __init__(self, n_samples=1024, n_dacs=8, channel=10,
+                 fifo_depth=128, event_cost_mu=120, dma_event_cost_mu=8,
+                 input_latency_mu=1000, strict=True, n_banks=2):
+        self.n_samples = n_samples
+        self.n_banks = n_banks
+        self.n_dacs = n_dacs
+        self.channel = channel
+        self.fifo_depth = fifo_depth
+        self.event_cost_mu = event_cost_mu
+        self.dma_event_cost_mu = dma_event_cost_mu
+        self.input_latency_mu = input_latency_mu
+        self.strict = strict
+
+        self.core = EmulatorCore(self)
+        self.core_dma = EmulatorDMA(self)
+        self.time = _TimeManager(self.core.ref_period)
+        self.spi = _SPIBus(self, 0)
+        self.ttls = {name: _TTLOut(self, i + 1) for i, name in enumerate(
+            ["dac_reset", "osc_en", "mmcx_sel", "refclk_sel"])}
+        self.ttls["dac_reset"].on_set = self.spi.reset
+        devices = dict(self.ttls, core=self.core, core_dma=self.core_dma,
+                       spi=self.spi)
+        self.shuttler = Shuttler(_DeviceManager(devices), channel, "spi",
+                                 "dac_reset", "osc_en", "mmcx_sel",
+                                 "refclk_sel")
+
+        # Gateware state
+        self.samples = np.zeros((n_dacs, n_banks, n_samples), dtype=np.int32)
+        self.write_bank = np.ones(n_dacs, dtype=np.int64)
+        self.play_bank = np.zeros(n_dacs, dtype=np.int64)
+        self.write_base = np.zeros(n_dacs, dtype=np.int64)
+        self.registers = np.zeros((n_dacs, 32), dtype=np.uint64)
+        self.registers[:, REG_LENGTH] = n_samples
+        self.registers[:, REG_NCO_ASF] = 2**DAC_WIDTH - 1
+        self.crc = [0]*n_dacs
+        # REG_SEGMENT words without the index
+        self.segments = np.zeros((n_dacs, PLAYLIST_DEPTH), dtype=np.uint64)
+        # SDRAM stream lanes, grown as written
+        self.stream = np.zeros(0, dtype=np.uint16)
+        self._stream_ptr = 0
+        self._stream_lanes = np.zeros(0, dtype=np.uint16)
+        # Control events in timestamp order: (timestamp, dac, reg, data)
+        self.log = []
+
+        # RTIO counter as seen by the CPU, and statistics
+        self.cpu_mu = 0
+        self.events = 0
+        self.underflows = 0
+        self.stall_mu = 0
+        self.min_slack_mu = None
+        # The timeline starts as after core.reset(), so kernels can run
+        # without one
+        self.time.now = RESET_SLACK_MU
+
+        self._pending = []
+        self._t = []
+        self._target = []
+        self._data = []
+        self._fifo = np.zeros(0, dtype=np.int64)
+        self._inputs = {}
+        self._recording = None
+        self._saved = None
+
+    def __enter__(self):
+        self._saved = (core_language._time_manager, driver.rtio_output,
+                       driver.rtio_output_wide, driver.rtio_input_data)
+        core_language.set_time_manager(self.time)
+        driver.rtio_output = self.output
+        driver.rtio_output_wide = self.output_wide
+        driver.rtio_input_data = self.input
+        return self
+
+    def __exit__(self, *exc):
+        (time_manager, driver.rtio_output, driver.rtio_output_wide,
+         driver.rtio_input_data) = self._saved
+        core_language.set_time_manager(time_manager)
+
+    # Event capture
+
+    def output(self, target, data):
+        self._capture(target, int(data) & 0xFFFFFFFF)
+
+    def output_wide(self, target, data):
+        self._capture(target, (int(data[0]) & 0xFFFFFFFF) |
+                              (int(data[1]) & 0xFFFFFFFF) << 32)
+
+    def _capture(self, target, data):
+        if self._recording is not None:
+            buffers = self._recording
+        else:
+            buffers = self._t, self._target, self._data
+        buffers[0].append(self.time.now)
+        buffers[1].append(target)
+        buffers[2].append(data)
+
+    def _seal(self):
+        if self._t:
+            n = len(self._t)
+            self._pending.append((
+                np.array(self._t, dtype=np.int64),
+                np.array(self._target, dtype=np.int64),
+                np.array(self._data, dtype=np.uint64),
+                np.full(n, self.event_cost_mu, dtype=np.int64)))
+            self._t, self._target, self._data = [], [], []
+
+    def submit(self, t, target, data, cost):
+        """Submit arrays of events, each costing `cost` machine units."""
+        self._seal()
+        t = np.asarray(t, dtype=np.int64)
+        self._pending.append((
+            t, np.broadcast_to(np.asarray(target, dtype=np.int64), t.shape),
+            np.broadcast_to(np.asarray(data, dtype=np.uint64), t.shape),
+            np.full(len(t), cost, dtype=np.int64)))
+
+    def queue_input(self, channel, t, value):
+        self._inputs.setdefault(channel, deque()).append((t, value))
+
+    def input(self, channel):
+        self.flush()
+        try:
+            t, value = self._inputs[channel].popleft()
+        except (KeyError, IndexError):
+            raise RuntimeError("no input pending on RTIO channel {}"
+                               .format(channel)) from None
+        self.cpu_mu = max(self.cpu_mu, t + self.input_latency_mu)
+        return np.int32(value - (1 << 32) if value >= 1 << 31 else value)
+
+    # Timing model and decoding
+
+    def flush(self):
+        """Time and decode all buffered events."""
+        self._seal()
+        if not self._pending:
+            return
+        t, target, data, cost = (np.concatenate(a)
+                                 for a in zip(*self._pending))
+        self._pending = []
+
+        # Submission times s[i] = max(s[i-1] + cost[i], t[i-depth]):
+        # u = s - cumsum(cost) is a running maximum.
+        fifo = np.concatenate([self._fifo, t])
+        index = np.arange(len(self._fifo), len(fifo)) - self.fifo_depth
+        free = np.full(len(t), np.iinfo(np.int64).min//2, dtype=np.int64)
+        free[index >= 0] = fifo[index[index >= 0]]
+        spent = np.cumsum(cost)
+        u = np.maximum.accumulate(
+            np.concatenate([[self.cpu_mu], free - spent]))[1:]
+        submitted = u + spent
+        slack = t - submitted
+
+        n = len(t)
+        underflow = np.flatnonzero(slack < 0)
+        if self.strict and len(underflow):
+            n = underflow[0]
+        if n:
+            self.stall_mu += int(submitted[n - 1] - self.cpu_mu - spent[n - 1])
+            self.cpu_mu = int(submitted[n - 1])
+            min_slack = int(slack[:n].min())
+            self.min_slack_mu = min_slack if self.min_slack_mu is None \
+                else min(self.min_slack_mu, min_slack)
+        self.events += n
+        self.underflows += len(underflow)
+        self._fifo = fifo[:len(fifo) - len(t) + n][-self.fifo_depth:]
+
+        mine = (target[:n] >> 8) == self.channel
+        self._decode(t[:n][mine], target[:n][mine] & 0xFF, data[:n][mine])
+
+        if self.strict and len(underflow):
+            i = underflow[0]
+            self.cpu_mu = int(submitted[i])
+            raise RTIOUnderflow(
+                "RTIO underflow at {} mu, channel {}, slack {} mu".format(
+                    t[i], target[i] >> 8, slack[i]))
+
+    def _decode(self, t, address, data):
+        if np.any(t[1:] < t[:-1]):
+            order = np.argsort(t, kind="stable")
+            t, address, data = t[order], address[order], data[order]
+        reg = (address >> 3).astype(np.int64)
+        dac = (address & 7).astype(np.int64)
+        # Input requests see the state left by the events before them
+        requests = np.flatnonzero(_STATUS[reg])
+        start = 0
+        for i in list(requests) + [len(t)]:
+            self._apply(t[start:i], reg[start:i], dac[start:i],
+                        data[start:i])
+            if i < len(t):
+                self._request(t[i], reg[i], dac[i], int(data[i]))
+            start = i + 1
+
+    def _apply(self, t, reg, dac, data):
+        n_words = self.n_samples//PACKED_SAMPLES
+        mask = (1 << DAC_WIDTH) - 1
+        stream = (reg == REG_STREAM_WRITE) | (reg == REG_STREAM_DATA)
+        if stream.any():
+            self._write_stream(reg[stream], data[stream])
+        local = _MEMORY[reg] | stream
+        control = ~local
+        if control.any():
+            self.log.append(np.rec.fromarrays(
+                [t[control], dac[control], reg[control], data[control]],
+                names="timestamp,dac,reg,data"))
+        trigger = reg == REG_TRIGGER
+        if trigger.any():
+            t, reg, dac, data = self._expand_trigger(t, reg, dac, data)
+            stream = np.zeros(len(reg), dtype=bool)
+        for d in np.flatnonzero(np.bincount(dac, minlength=self.n_dacs)):
+            mine = dac == d
+            r, v = reg[mine], data[mine]
+
+            # Writes go to the write bank at the time of the write, from
+            # the base set by the last REG_WRITE_BASE. Bank changes are few
+            # and followed one by one.
+            bank = np.empty(len(r), dtype=np.int64)
+            done = 0
+            for i in np.flatnonzero((r == REG_SWAP) | (r == REG_BANK) |
+                                    (r == REG_WRITE_BANK)):
+                bank[done:i] = self.write_bank[d]
+                if r[i] == REG_SWAP:
+                    self.write_bank[d], self.play_bank[d] = (
+                        self.play_bank[d], self.write_bank[d])
+                elif r[i] == REG_BANK:
+                    self.play_bank[d] = int(v[i]) % self.n_banks
+                else:
+                    self.write_bank[d] = int(v[i]) % self.n_banks
+                bank[i] = self.write_bank[d]
+                done = i + 1
+            bank[done:] = self.write_bank[d]
+            is_base = r == REG_WRITE_BASE
+            last = np.maximum.accumulate(
+                np.where(is_base, np.arange(len(r)), -1))
+            base = np.where(
+                last >= 0,
+                (v[np.maximum(last, 0)] >> np.uint64(2)).astype(np.int64),
+                self.write_base[d]) % n_words
+            if is_base.any():
+                self.write_base[d] = base[-1]
+
+            single = r == REG_SAMPLE
+            packed = r == REG_SAMPLES_PACKED
+            rows = np.flatnonzero(single | packed)
+            if len(rows):
+                w = v[rows]
+                lane = np.arange(PACKED_SAMPLES)
+                values = ((w[:, None] >> (lane*DAC_WIDTH).astype(np.uint64))
+                          & np.uint64(mask)).astype(np.uint16)
+                offset = (w >> np.uint64(56)).astype(np.int64)
+                key = ((bank[rows]*self.n_samples + PACKED_SAMPLES *
+                        ((base[rows] + offset) % n_words))[:, None] + lane)
+                one = single[rows]
+                if one.any():
+                    # REG_SAMPLE writes the first lane only, at its address
+                    key[one, 0] = bank[rows[one]]*self.n_samples + (
+                        (w[one] >> np.uint64(DAC_WIDTH)).astype(np.int64) %
+                        self.n_samples)
+                    valid = ~one[:, None] | (lane == 0)
+                    key, values = key[valid], values[valid]
+                key, values = key.reshape(-1), values.reshape(-1)
+                # In time order, so that later writes to the same sample
+                # win
+                self.samples[d].reshape(-1)[key] = values
+                self.crc[d] = zlib.crc32(values.astype("<u2", copy=False).tobytes(),
+                                         self.crc[d])
+
+            segment = r == REG_SEGMENT
+            if segment.any():
+                # Later writes to the same entry win
+                index = (v[segment] >> np.uint64(56)).astype(np.int64)
+                self.segments[d, index % PLAYLIST_DEPTH] = (
+                    v[segment] & np.uint64(2**56 - 1))
+
+            for k in np.unique(r[~(single | packed | is_base | segment) &
+                                 ~stream[mine]]):
+                self.registers[d, k] = v[r == k][-1]
+
+    def _expand_trigger(self, t, reg, dac, data):
+        # One REG_ENABLE per DAC in the masks, in place of the trigger. The
+        # stream events were applied already and are dropped.
+        keep = ~((reg == REG_STREAM_WRITE) | (reg == REG_STREAM_DATA))
+        t, reg, dac, data = t[keep], reg[keep], dac[keep], data[keep]
+        trigger = reg == REG_TRIGGER
+        bit = np.arange(self.n_dacs, dtype=np.uint64)
+        start = (data[:, None] >> bit) & np.uint64(1)
+        stop = (data[:, None] >> (bit + np.uint64(8))) & np.uint64(1)
+        selected = trigger[:, None] & ((start | stop) == 1)
+        n = np.where(trigger, selected.sum(axis=1), 1)
+        index = np.repeat(np.arange(len(reg)), n)
+        t, reg, dac, data = t[index], reg[index], dac[index], data[index]
+        rows, dacs = np.nonzero(selected)
+        position = np.cumsum(n) - n
+        slot = position[rows] + (np.arange(len(rows)) -
+                                 np.searchsorted(rows, rows))
+        reg[slot] = REG_ENABLE
+        dac[slot] = dacs
+        data[slot] = (stop[rows, dacs] == 0).astype(np.uint64)
+        # Triggers selecting no DAC have no effect
+        keep = reg != REG_TRIGGER
+        return t[keep], reg[keep], dac[keep], data[keep]
+
+    def _write_stream(self, reg, data):
+        # SDRAM is only written in whole words, as by the gateware
+        word_lanes = STREAM_WORD_WIDTH//STREAM_LANE_WIDTH
+        shift = (np.arange(4)*STREAM_LANE_WIDTH).astype(np.uint64)
+        for segment in np.split(np.arange(len(reg)),
+                                np.flatnonzero(reg == REG_STREAM_WRITE)):
+            if len(segment) and reg[segment[0]] == REG_STREAM_WRITE:
+                self._stream_ptr = int(data[segment[0]] & np.uint64(
+                    0xFFFFFFFF))*word_lanes
+                self._stream_lanes = np.zeros(0, dtype=np.uint16)
+                segment = segment[1:]
+            lanes = ((data[segment][:, None] >> shift) &
+                     np.uint64(0xFFFF)).astype(np.uint16).reshape(-1)
+            lanes = np.concatenate([self._stream_lanes, lanes])
+            n = len(lanes) - len(lanes) % word_lanes
+            end = self._stream_ptr + n
+            if end > len(self.stream):
+                self.stream = np.concatenate([
+                    self.stream,
+                    np.zeros(end - len(self.stream), dtype=np.uint16)])
+            self.stream[self._stream_ptr:end] = lanes[:n]
+            self._stream_ptr = end
+            self._stream_lanes = lanes[n:]
+
+    def _request(self, t, reg, dac, data):
+        if reg == REG_CHECKSUM:
+            value = self.crc[dac]
+            if data & 1:
+                self.crc[dac] = 0
+        elif reg == REG_STREAM_STATUS or reg == REG_STATUS:
+            value = 0
+        else:
+            adr = (data >> DAC_WIDTH) % self.n_samples
+            value = int(self.samples[dac, self.write_bank[dac], adr])
+        self.queue_input(self.channel, t, value)
+
+    # Core device operations and inspection
+
+    def reset(self):
+        """Behave as `core.reset()`: drop the FIFOs, restart the timeline
+        with the usual slack."""
+        self.flush()
+        self._fifo = np.zeros(0, dtype=np.int64)
+        self._inputs.clear()
+        self.time.now = self.cpu_mu + RESET_SLACK_MU
+
+    @contextmanager
+    def measure(self):
+        """Measure CPU time, timeline advance, events, stalls and
+        underflows of a block."""
+        span = _Span()
+        self.flush()
+        start = (self.cpu_mu, self.time.now, self.events, self.stall_mu,
+                 self.underflows)
+        try:
+            yield span
+        finally:
+            self.flush()
+            span.cpu_mu = self.cpu_mu - start[0]
+            span.timeline_mu = self.time.now - start[1]
+            span.events = self.events - start[2]
+            span.stall_mu = self.stall_mu - start[3]
+            span.underflows = self.underflows - start[4]
+
+    def active_samples(self, dac):
+        """Bank that plays once pending swaps and bank selects have taken
+        effect."""
+        return self.samples[dac, self.play_bank[dac]]
+
+    def stream_samples(self, word, length):
+        """Stream written to SDRAM words `word` to `word + length`, as an
+        `(n_dacs, n_samples)` array."""
+        self.flush()
+        word_lanes = STREAM_WORD_WIDTH//STREAM_LANE_WIDTH
+        lanes = self.stream[word*word_lanes:(word + length)*word_lanes]
+        return lanes.astype(np.int32).reshape(-1, self.n_dacs).T
+
+    def playlist(self, dac):
+        """Segments the DAC plays from its playlist when started, as
+        `(start, length, repeat)` tuples in order, up to the end of the
+        playlist, a segment played until stopped or the first entry played
+        again. Empty if the playlist is off."""
+        self.flush()
+        control = int(self.registers[dac, REG_PLAYLIST])
+        if not control & 1 << 8:
+            return []
+        played = []
+        index = control & (PLAYLIST_DEPTH - 1)
+        visited = set()
+        while index < PLAYLIST_DEPTH and index not in visited:
+            visited.add(index)
+            word = int(self.segments[dac, index])
+            start, length, repeat = (word & 0xFFFF, word >> 16 & 0xFFFF,
+                                     word >> 32 & 0xFFFF)
+            played.append((start, length, repeat))
+            if not repeat:
+                break
+            index = word >> 48
+        return played
+
+    def enabled(self, dac):
+        return bool(self.registers[dac, driver.REG_ENABLE] & np.uint64(1))
+
+    def control_log(self):
+        """Control events so far, as a record array."""
+        self.flush()
+        if not self.log:
+            return np.rec.fromarrays([[], [], [], []],
+                                     names="timestamp,dac,reg,data")
+        return np.concatenate(self.log).view(np.recarray)
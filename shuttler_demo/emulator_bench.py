@@ -0,0 +1,212 @@
+"""Benchmarks of the Shuttler driver against the offline emulator.
+
+Runs without a board: the driver is interpreted as Python against
+:class:`shuttler_demo.emulator.ShuttlerEmulator`. For each CPU cost per
+event it measures:
+
+* upload: packed sample upload with the adaptive event spacing, against
+  the fixed spacing of 100 RTIO cycles per event it replaced, checked with
+  REG_CHECKSUM and without underflows. Apart from waiting out the initial
+  break_realtime() slack, the adaptive upload must not stall on the RTIO
+  FIFO, and it must be faster.
+* events: host throughput of the emulator, for REG_SAMPLES_PACKED events
+  submitted as one array (rewriting each sample many times, the last
+  write must win) and for driver uploads interpreted as Python,
+* nco: NCO frequency tuning words up to and past sample_rate/2, as the
+  shuttler_test_nco.py sweep, wrapped modulo 2**32.
+
+Run with::
+
+    python -m shuttler_demo.emulator_bench [--costs 120 400 ...]
+
+The exit status is non-zero if any check failed.
+"""
+
+import argparse
+import sys
+import time
+import warnings
+
+import numpy as np
+
+from artiq.language.core import delay_mu
+
+from shuttler_demo.coredevice.shuttler import (
+    REG_WRITE_BASE, REG_SAMPLES_PACKED, REG_NCO_FTW)
+from shuttler_demo.emulator import ShuttlerEmulator, RESET_SLACK_MU
+from shuttler_demo.waveforms import PACKED_SAMPLES, PACKED_WINDOW, pack_samples
+
+
+N_SAMPLES = 8192
+# Event spacing of sample uploads before it followed the CPU rate
+FIXED_SPACING_CYCLES = 100
+
+
+def _ramp(n_samples):
+    return (np.arange(n_samples)*7 % (1 << 14)).astype(np.int32)
+
+
+def _fixed_upload(shuttler, dac, words):
+    spacing = FIXED_SPACING_CYCLES*shuttler.ref_period_mu
+    for i in range(len(words)//2):
+        if i % PACKED_WINDOW == 0:
+            shuttler.write(dac, REG_WRITE_BASE, i*PACKED_SAMPLES)
+            delay_mu(shuttler.ref_period_mu)
+        shuttler.write_wide(dac, REG_SAMPLES_PACKED,
+                            words[2*i] & 0xFFFFFFFF | words[2*i + 1] << 32)
+        delay_mu(spacing)
+
+
+def _upload(event_cost_mu, upload):
+    mu = _ramp(N_SAMPLES)
+    words = [int(w) for w in pack_samples(mu)]
+    emu = ShuttlerEmulator(n_samples=N_SAMPLES, event_cost_mu=event_cost_mu,
+                           strict=False)
+    with emu:
+        emu.core.reset()
+        emu.shuttler.read_checksum(0, True)
+        emu.core.break_realtime()
+        with emu.measure() as span:
+            upload(emu.shuttler, 0, words)
+        ok = emu.shuttler.verify(0, [int(x) for x in mu])
+    return span, ok and not span.underflows
+
+
+def bench_upload(event_cost_mu):
+    n_events = N_SAMPLES//PACKED_SAMPLES
+    adaptive, adaptive_ok = _upload(
+        event_cost_mu, lambda sh, dac, words: sh.write_packed_words(dac, words))
+    fixed, fixed_ok = _upload(event_cost_mu, _fixed_upload)
+    speedup = fixed.cpu_mu/adaptive.cpu_mu
+    return {
+        "mu/event": adaptive.cpu_mu/n_events,
+        "stall mu": adaptive.stall_mu,
+        "fixed mu/event": fixed.cpu_mu/n_events,
+        "speedup": speedup,
+    }, (adaptive_ok and fixed_ok and adaptive.stall_mu <= RESET_SLACK_MU
+        and speedup > 1)
+
+
+def _rate(n_events, run):
+    # Best of a few runs, host timing is noisy
+    best = None
+    for _ in range(3):
+        t = time.perf_counter()
+        ok = run()
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return n_events/best, ok
+
+
+def bench_events(event_cost_mu):
+    n_events = 1 << 18
+    n_samples = 1024
+    n_words = n_samples//PACKED_SAMPLES
+    i = np.arange(n_events, dtype=np.uint64)
+    lanes = (i[:, None]*np.uint64(PACKED_SAMPLES) +
+             np.arange(PACKED_SAMPLES, dtype=np.uint64)) % np.uint64(1 << 14)
+    data = (i % np.uint64(n_words)) << np.uint64(56)
+    for lane in range(PACKED_SAMPLES):
+        data |= lanes[:, lane] << np.uint64(14*lane)
+    expected = lanes[-n_words:].reshape(-1).astype(np.int32)
+
+    def raw():
+        emu = ShuttlerEmulator(n_samples=n_samples, strict=False)
+        with emu:
+            emu.submit(np.arange(n_events, dtype=np.int64)*8 +
+                       RESET_SLACK_MU, emu.channel << 8 |
+                       REG_SAMPLES_PACKED << 3, data, event_cost_mu)
+            emu.flush()
+        return np.array_equal(emu.samples[0, emu.write_bank[0]], expected)
+
+    mu = _ramp(N_SAMPLES)
+    words = [int(w) for w in pack_samples(mu)]
+
+    def driver(upload, samples):
+        def run():
+            emu = ShuttlerEmulator(n_samples=N_SAMPLES,
+                                   event_cost_mu=event_cost_mu)
+            with emu:
+                emu.core.reset()
+                getattr(emu.shuttler, upload)(0, samples)
+                emu.flush()
+            return np.array_equal(emu.samples[0, emu.write_bank[0]], mu)
+        return run
+
+    n_driver = N_SAMPLES//PACKED_SAMPLES + N_SAMPLES//(
+        PACKED_SAMPLES*PACKED_WINDOW)
+    raw_rate, raw_ok = _rate(n_events, raw)
+    words_rate, words_ok = _rate(
+        n_driver, driver("write_packed_words", words))
+    samples_rate, samples_ok = _rate(
+        n_driver, driver("write_samples_packed", [int(x) for x in mu]))
+    return {
+        "packed ev/s": raw_rate,
+        "write_packed_words ev/s": words_rate,
+        "write_samples_packed ev/s": samples_rate,
+    }, raw_ok and words_ok and samples_ok
+
+
+def bench_nco(event_cost_mu):
+    emu = ShuttlerEmulator(event_cost_mu=event_cost_mu)
+    fs = emu.shuttler.sample_rate
+    freqs = [fs/1024*k for k in (1, 256, 511, 512, 513)] + [
+        -fs/2, fs/2 - fs/2**32, fs, 1.25*fs, -0.75*fs]
+    wrong = 0
+    with emu:
+        emu.core.reset()
+        for freq in freqs:
+            # An int32 conversion out of range overflows on the core
+            # device; NumPy warns (or raises) about it
+            with warnings.catch_warnings():
+                warnings.simplefilter("error", DeprecationWarning)
+                try:
+                    emu.shuttler.set_nco_frequency(0, freq)
+                except (DeprecationWarning, OverflowError):
+                    wrong += 1
+                    continue
+            emu.flush()
+            ftw = int(emu.registers[0, REG_NCO_FTW]) & 0xFFFFFFFF
+            wrong += ftw != round(freq/fs*2**32) % 2**32
+    return {"frequencies": len(freqs), "wrong": wrong}, not wrong
+
+
+BENCHMARKS = [
+    ("upload", bench_upload),
+    ("events", bench_events),
+    ("nco", bench_nco),
+]
+
+
+def _format(metrics):
+    return ", ".join(
+        "{} {:.3g}".format(k, v) if isinstance(v, float) else
+        "{} {}".format(k, v)
+        for k, v in metrics.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Shuttler driver emulator benchmarks")
+    parser.add_argument("--costs", type=int, nargs="+", default=[120, 400],
+                        help="CPU costs per event to test, in mu")
+    parser.add_argument("--only", choices=[name for name, _ in BENCHMARKS],
+                        nargs="+", help="run only these benchmarks")
+    args = parser.parse_args()
+
+    failed = 0
+    for cost in args.costs:
+        for name, bench in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            t = time.monotonic()
+            metrics, ok = bench(cost)
+            failed += not ok
+            print("{:5d} {:9s} {:4s} {} ({:.1f} s)".format(
+                cost, name, "ok" if ok else "FAIL", _format(metrics),
+                time.monotonic() - t))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+from artiq.experiment import *
+
+from shuttler_demo.coredevice.shuttler import MODE_NCO, DAC_ALL
+
+
+Fs = 125e6
+N_SAMPLES = 1024
+
+
+class NCOSweep(EnvExperiment):
+
+    def build(self):
+        self.setattr_device("core")
+        self.setattr_device("shuttler")
+        # Skip the DAC reset and settling time if the card is already set up
+        self.setattr_argument("warm_start", BooleanValue(False))
+
+    @kernel
+    def run_kernel(self):
+        print("Running...")
+        self.core.reset()
+        if self.warm_start:
+            self.shuttler.warm_init()
+            self.core.break_realtime()
+        else:
+            self.shuttler.init()
+            delay(1*s)
+        for i in range(8):
+            self.shuttler.set_mode(i, MODE_NCO)
+            delay(100*ns)
+            self.shuttler.set_nco_amplitude(i, 1.)
+            delay(100*ns)
+        self.shuttler.trigger(DAC_ALL)
+        delay(100*ns)
+        for freq in self.freqs:
+            print("Current frequency:", freq, "Hz")
+            for i in range(8):
+                self.shuttler.set_nco_frequency(i, freq)
+                delay(100*ns)
+            # The DACs change frequency 100 ns apart: restart all NCOs from
+            # phase 0 in the same DAC cycle to realign them
+            self.shuttler.trigger(DAC_ALL)
+            delay(self.dwell)
+
+    def run(self):
+        # Same tones as shuttler_test_sine.py, one event per DAC and step
+        base_f = Fs/N_SAMPLES
+        self.freqs = [base_f*k for k in
+                      [1, 2, 4, 6, 8, 10, 11, 12, 14, 16, 24, 32, 48, 64,
+                       128, 256, 512]]
+        self.dwell = 1*s
+        self.run_kernel()
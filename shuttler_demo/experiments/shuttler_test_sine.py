@@ -1,9 +1,17 @@
 from artiq.experiment import *
 
 from artiq.coredevice.spi2 import *
+from time import monotonic
+
 import numpy as np
 from numpy import int32
 
+from shuttler_demo.coredevice.shuttler import DAC_ALL
+from shuttler_demo.waveforms import voltage_to_mu, pack_samples
+from shuttler_demo.waveform_cache import (WaveformCache, default_cache_dir,
+                                          make_key)
+from shuttler_demo.pipeline import WaveformProducer
+
 
 N_SAMPLES = 1024
 Fs = 125e6
@@ -13,13 +21,12 @@ def generate_sin(amplitude, frequency):
     time = np.linspace(0, N_SAMPLES-1, N_SAMPLES)
     return amplitude*np.cos(2 * np.pi * frequency * time / Fs)
 
-def voltage_to_mu(value):
-    data = int32(round((0x2000/1.)*value)) + int32(0x2000)
-    if data < 0:
-        data = 0
-    if data > 0x3fff:
-        data = 0x3FFF
-    return data
+
+def compile_sin(cache, amplitude, frequency):
+    # Machine units of generate_sin(), reused across sweep steps and runs
+    key = make_key("sin", amplitude, frequency, N_SAMPLES, Fs)
+    return cache.get_or_compute(
+        key, lambda: voltage_to_mu(generate_sin(amplitude, frequency)))
 
 
 class SquareGeneratorMaxFreq(EnvExperiment):
@@ -27,25 +34,87 @@ class SquareGeneratorMaxFreq(EnvExperiment):
     def build(self):
         self.setattr_device("core")
         self.setattr_device("shuttler")
-        self.setattr_device("shuttler_awg_reset")
+        # Batch mode runs the whole sweep in one kernel: compiled and
+        # initialized once, waveforms fetched by RPC, steps timed by dwell
+        self.setattr_argument("batch", BooleanValue(True))
+        self.setattr_argument("dwell", NumberValue(1*s, unit="s"))
+        # Waveforms prepared in the background ahead of the kernel
+        self.setattr_argument("prefetch",
+                              NumberValue(4, ndecimals=0, step=1, min=1))
+        # Skip the DAC reset and settling time if the card is already set up
+        self.setattr_argument("warm_start", BooleanValue(False))
 
     @kernel
-    def run_kernel(self):
-        print("Running...")
+    def init_dacs(self):
         self.core.reset()
+        if self.warm_start:
+            print("Registers rewritten:", self.shuttler.warm_init())
+            self.core.break_realtime()
+            return
         self.shuttler.init()
         delay(1*s)
         print("DAC timing status:")
         for i in range(8):
             print("DAC", i, ":", self.shuttler.get_dac_timing_status(i))
             delay(10*ms)
-        self.shuttler.write_samples(self.values)
-        delay(1*s)
-        self.shuttler_awg_reset.on()
-        delay(100*ns)
-        self.shuttler_awg_reset.off()
 
-    
+    @kernel
+    def run_kernel(self):
+        print("Running...")
+        # Traces are recorded and their handles fetched ahead of the
+        # realtime section, so playback does not wait on the host
+        for i in range(8):
+            self.shuttler.record_samples(self.trace_names[i], i, self.values)
+        handles = [self.shuttler.get_samples_handle(name)
+                   for name in self.trace_names]
+        self.init_dacs()
+        for i in range(8):
+            self.shuttler.playback_samples(handles[i])
+            self.shuttler.set_length(i, len(self.values))
+            delay(100*ns)
+            self.shuttler.swap(i)
+            delay(100*ns)
+        # All DACs start from the first sample in the same cycle
+        self.shuttler.trigger(DAC_ALL)
+
+    def get_words(self, step) -> TList(TInt32):
+        # Usually already computed by the producer while the previous step
+        # was playing
+        return list(next(self.producer))
+
+    @rpc(flags={"async"})
+    def step_done(self, step, upload_mu):
+        now = monotonic()
+        print("Step {}: {} Hz, upload {:.3f} ms, step {:.3f} s".format(
+            step, self.freqs[step],
+            self.core.mu_to_seconds(upload_mu)*1e3, now - self.t_step))
+        self.t_step = now
+
+    @kernel
+    def run_sweep(self):
+        print("Running sweep...")
+        self.init_dacs()
+        for step in range(len(self.freqs)):
+            words = self.get_words(step)
+            self.core.break_realtime()
+            t0 = now_mu()
+            # Uploads go to the write bank while the previous step keeps
+            # playing; the swap then takes effect at its next wrap
+            for i in range(8):
+                self.shuttler.write_packed_words(i, words)
+                if step == 0:
+                    self.shuttler.set_length(i, N_SAMPLES)
+                    delay(100*ns)
+                self.shuttler.swap(i)
+                delay(100*ns)
+            if step == 0:
+                self.shuttler.trigger(DAC_ALL)
+                delay(100*ns)
+            self.core.wait_until_mu(now_mu())
+            self.step_done(step, now_mu() - t0)
+            delay(self.dwell)
+        self.core.wait_until_mu(now_mu())
+
     def run(self):
         N_SAMPLES = 1024
         Fs = 125e6
@@ -77,13 +146,24 @@ class SquareGeneratorMaxFreq(EnvExperiment):
             base_f*512,
         ]
         
+        cache = WaveformCache(directory=default_cache_dir())
+        if self.batch:
+            self.freqs = freqs
+            self.t_step = self.t_start = monotonic()
+            with WaveformProducer(
+                    lambda freq: pack_samples(compile_sin(cache, 1, freq)),
+                    freqs, depth=int(self.prefetch)) as self.producer:
+                self.run_sweep()
+            print("Sweep of {} steps took {:.1f} s, {} waveform stalls "
+                  "({:.3f} s)".format(
+                      len(freqs), monotonic() - self.t_start,
+                      self.producer.stalls, self.producer.stall_time))
+            return
+
         for freq in freqs:
             base_freq = freq
-            self.signal = generate_sin(1, 1*base_freq)
-            self.signal = self.signal.tolist()
-            self.values = [int32(0) for i in range(len(self.signal))]
-            for i in range(len(self.signal)):
-                self.values[i] = voltage_to_mu(self.signal[i])
+            self.values = list(compile_sin(cache, 1, 1*base_freq))
+            self.trace_names = [self.shuttler.dma_trace_name(i, self.values)
+                                for i in range(8)]
             self.run_kernel()
             input(f"Current frequency: {base_freq} MHz [ENTER]")
-
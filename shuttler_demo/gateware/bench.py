@@ -0,0 +1,700 @@
+"""Cycle-accurate simulation benchmarks of ShuttlerSamples.
+
+Runs without a board or toolchain: the core is instantiated against a
+stand-in target and simulated with Migen, with the rio_phy and dac clock
+domains at their real periods (and a phase offset, as they are
+asynchronous). For each storage depth it measures:
+
+* upload: sustained packed write throughput, checked with REG_CHECKSUM,
+* latency: RTIO event to DAC output, in dac cycles,
+* loop: start/length/repeat playback, sample exact at the wraps,
+* commands: back-to-back control events reaching the dac domain, and
+  any dropped ones flagged in REG_STATUS (with a slower dac clock),
+* trigger: REG_TRIGGER start, restart and stop latency, equal on all
+  DACs,
+* playlist: segments chained back to back from the playlist table,
+  sample exact, including single sample segments,
+* banks: switching between preloaded banks with REG_BANK, at loop wraps
+  only,
+* ddr: MODE_DDR loops, two samples per dac cycle on the two output
+  halves, sample exact, and DCLKIO moved from 180 to 90 degrees on that
+  DAC only,
+* gain: REG_GAIN and REG_OFFSET applied to a playing loop, saturation
+  included, against the expected arithmetic,
+* stream: SDRAM stream upload and playback against an SDRAM model with a
+  fixed latency, sample exact, no stream event dropped, and the rate the
+  reader sustains.
+
+Run with::
+
+    python -m shuttler_demo.gateware.bench [--depths 256 1024 ...]
+
+The exit status is non-zero if any check failed, so gateware changes can
+be regression-checked on a plain Linux box. Channels are identical, so only
+two are instantiated by default to keep the (slow) simulation short.
+"""
+
+import argparse
+import sys
+import time
+
+from migen import *
+from migen.sim import passive
+from misoc.interconnect import wishbone
+
+from shuttler_demo.gateware.cores.shuttler import (
+    ShuttlerSamples, DAC_DATA_WIDTH, SAMPLE_LANES, REG_ENABLE,
+    REG_SAMPLES_PACKED, REG_WRITE_BASE, REG_SWAP, REG_START, REG_LENGTH,
+    REG_REPEAT, REG_CHECKSUM, REG_MODE, REG_STREAM_WRITE, REG_STREAM_DATA,
+    REG_STREAM_READ, REG_STREAM_RUN, REG_STREAM_STATUS, REG_TRIGGER,
+    REG_SEGMENT, REG_PLAYLIST, REG_BANK, REG_WRITE_BANK, MODE_TABLE,
+    MODE_STREAM, MODE_DDR, STREAM_LANE_WIDTH, PLAYLIST_DEPTH, REG_GAIN,
+    REG_OFFSET, REG_STATUS, GAIN_FRAC_WIDTH)
+from shuttler_demo.waveforms import checksum
+
+
+# Real clocks: 125 MHz RTIO, 125 MHz clk0_m2c and 125 MHz sys, in ns
+RIO_PERIOD = 8
+DAC_PERIOD = 8
+DAC_PHASE = 3
+SYS_PERIOD = 8
+SYS_PHASE = 0
+# Native SDRAM bus of the Genesys2 target and an estimate of its latency
+# through the controller, in sys cycles
+SDRAM_WIDTH = 256
+SDRAM_LATENCY = 16
+# Native SDRAM ports the stream reads are pipelined over, as add_std
+STREAM_PORTS = 10
+# Shallow, so that short streams already depend on sustained reads
+STREAM_FIFO_DEPTH = 8
+STREAM_SAMPLES = 256
+
+
+class _StandInPlatform:
+    def request(self, name, number=None):
+        if name.endswith("_clk0_m2c"):
+            return Record([("p", 1), ("n", 1)])
+        if name.endswith("_dac"):
+            return Record([("data", DAC_DATA_WIDTH), ("dclkio", 1)])
+        return Signal()
+
+    def add_period_constraint(self, *args):
+        pass
+
+
+class _StandInTarget(Module):
+    # What ShuttlerSamples needs from a MiSoC target; pads, LEDs and DDR
+    # outputs end up here and are not simulated.
+    def __init__(self):
+        self.platform = _StandInPlatform()
+
+
+class _Bench:
+    def __init__(self, n_samples, n_dacs=2, dac_period=DAC_PERIOD,
+                 dac_phase=DAC_PHASE, sdram_latency=SDRAM_LATENCY,
+                 stream=False, n_banks=2, ddr=False,
+                 stream_ports=STREAM_PORTS):
+        self.n_samples = n_samples
+        self.n_dacs = n_dacs
+        self.dac_period = dac_period
+        self.dac_phase = dac_phase
+        self.sdram_latency = sdram_latency
+        self.buses = [wishbone.Interface(SDRAM_WIDTH)
+                      for _ in range(stream_ports if stream else 0)]
+        self.ddr = ddr
+        self.dut = ShuttlerSamples(_StandInTarget(), 1, Signal(),
+                                   n_samples=n_samples, n_dacs=n_dacs,
+                                   stream_bus=self.buses or None,
+                                   stream_fifo_depth=STREAM_FIFO_DEPTH,
+                                   n_banks=n_banks, ddr=ddr)
+        self.rio_cycle = 0
+        self.replies = []
+        self.sdram = {}
+        # sys cycles at which SDRAM reads completed
+        self.sdram_reads = []
+
+    def run(self, rio, dac=(), dac2x=()):
+        generators = {
+            "rio_phy": [rio, self._replies()],
+            "dac": list(dac)
+        }
+        clocks = {
+            "rio_phy": RIO_PERIOD,
+            "dac": (self.dac_period, self.dac_phase)
+        }
+        if self.buses:
+            generators["sys"] = [self._sdram(bus) for bus in self.buses]
+            clocks["sys"] = (SYS_PERIOD, SYS_PHASE)
+        if self.ddr:
+            # In phase with the dac clock
+            period = self.dac_period//2
+            generators["dac2x"] = list(dac2x)
+            clocks["dac2x"] = (period, self.dac_phase % period)
+        run_simulation(self.dut, generators, clocks=clocks)
+
+    def rio_time(self, cycle):
+        return cycle*RIO_PERIOD
+
+    def dac_time(self, cycle):
+        return cycle*self.dac_period + self.dac_phase
+
+    def event(self, reg, dac, data, hold=True):
+        o = self.dut.rtlink.o
+        yield o.address.eq(reg << 3 | dac)
+        yield o.data.eq(data & (2**64 - 1))
+        yield o.stb.eq(1)
+        yield
+        self.rio_cycle += 1
+        if hold:
+            yield o.stb.eq(0)
+
+    def idle(self, cycles):
+        yield self.dut.rtlink.o.stb.eq(0)
+        for _ in range(cycles):
+            yield
+            self.rio_cycle += 1
+
+    def upload(self, dac, mu):
+        # Back-to-back packed writes, one per rio_phy cycle
+        window = 256*SAMPLE_LANES
+        for i in range(0, len(mu), SAMPLE_LANES):
+            if i % window == 0:
+                yield from self.event(REG_WRITE_BASE, dac, i, hold=False)
+            word = (i % window)//SAMPLE_LANES << SAMPLE_LANES*DAC_DATA_WIDTH
+            for j in range(SAMPLE_LANES):
+                word |= mu[i + j] << j*DAC_DATA_WIDTH
+            yield from self.event(REG_SAMPLES_PACKED, dac, word, hold=False)
+        yield from self.idle(1)
+
+    @passive
+    def _replies(self):
+        i = self.dut.rtlink.i
+        while True:
+            if (yield i.stb):
+                self.replies.append((yield i.data))
+            yield
+
+    @passive
+    def _sdram(self, bus):
+        # Single-cycle wishbone slave answering sdram_latency cycles after
+        # the request, one per port on a shared memory
+        cycle = 0
+        while True:
+            if (yield bus.cyc) and (yield bus.stb):
+                for _ in range(self.sdram_latency):
+                    yield
+                    cycle += 1
+                adr = yield bus.adr
+                if (yield bus.we):
+                    self.sdram[adr] = yield bus.dat_w
+                else:
+                    yield bus.dat_r.eq(self.sdram.get(adr, 0))
+                    self.sdram_reads.append(cycle)
+                yield bus.ack.eq(1)
+                yield
+                yield bus.ack.eq(0)
+                cycle += 1
+            yield
+            cycle += 1
+
+    def output_monitor(self, dac, trace, ddr=False):
+        # With ddr, both halves of each cycle, half a dac period apart
+        channel = self.dut.channels[dac]
+
+        @passive
+        def monitor():
+            cycle = 0
+            while True:
+                t = self.dac_time(cycle)
+                trace.append((t, (yield channel.output)))
+                if ddr:
+                    trace.append((t + self.dac_period/2,
+                                  (yield channel.output2)))
+                yield
+                cycle += 1
+        return monitor()
+
+    def dclkio_monitor(self, dac, trace):
+        # DCLKIO level per quarter dac cycle, as (phase in quarters, level):
+        # the DDR register takes o1 and o2 at the next dac2x edge
+        clock_out = self.dut.clock_outs[dac]
+        quarter = self.dac_period//4
+
+        @passive
+        def monitor():
+            cycle = 1
+            while True:
+                t = cycle*2*quarter
+                trace.append((t//quarter % 4, (yield clock_out.o1)))
+                trace.append(((t + quarter)//quarter % 4,
+                              (yield clock_out.o2)))
+                yield
+                cycle += 1
+        return monitor()
+
+
+def _ramp(n):
+    # Distinct, non-zero samples: any skipped or repeated one shows
+    return [1 + i % (2**DAC_DATA_WIDTH - 1) for i in range(n)]
+
+
+def bench_upload(n_samples, **options):
+    bench = _Bench(n_samples, **options)
+    mu = _ramp(n_samples)
+    span = []
+
+    def rio():
+        yield from bench.event(REG_CHECKSUM, 1, 1)
+        start = bench.rio_cycle
+        yield from bench.upload(1, mu)
+        span.append(bench.rio_cycle - 1 - start)
+        yield from bench.event(REG_CHECKSUM, 1, 0)
+        yield from bench.idle(4)
+
+    bench.run(rio())
+    cycles = span[0]
+    return {
+        "cycles": cycles,
+        "samples/cycle": n_samples/cycles,
+        "MS/s": n_samples/(cycles*RIO_PERIOD)*1e3,
+    }, bench.replies[-1:] == [checksum(mu)]
+
+
+def bench_latency(n_samples, **options):
+    bench = _Bench(n_samples, **options)
+    mu = _ramp(n_samples)
+    trace = []
+    enabled_at = []
+
+    def rio():
+        yield from bench.upload(0, mu)
+        yield from bench.event(REG_SWAP, 0, 0)
+        yield from bench.idle(16)
+        enabled_at.append(bench.rio_time(bench.rio_cycle))
+        yield from bench.event(REG_ENABLE, 0, 1)
+        yield from bench.idle(64)
+
+    bench.run(rio(), [bench.output_monitor(0, trace)])
+    first = next((t for t, v in trace if v != 0), None)
+    if first is None:
+        return {"dac cycles": None}, False
+    samples = [v for t, v in trace if t >= first][:32]
+    return {
+        "dac cycles": (first - enabled_at[0])/bench.dac_period
+    }, samples == mu[:len(samples)]
+
+
+def bench_loop(n_samples, **options):
+    ok = True
+    cases = [
+        (0, 0, 2),                              # whole bank
+        (n_samples//4, n_samples//2, 3),
+        (n_samples - 3, 3, 4),                  # up to the last sample
+        (5, 1, 5),                              # single sample loop
+    ]
+    for start, length, repeat in cases:
+        bench = _Bench(n_samples, **options)
+        mu = _ramp(n_samples)
+        trace = []
+        loop = mu[start:start + (length or n_samples)]
+        played = len(loop)*repeat
+
+        def rio():
+            yield from bench.upload(0, mu)
+            yield from bench.event(REG_START, 0, start)
+            yield from bench.event(REG_LENGTH, 0, length)
+            yield from bench.event(REG_REPEAT, 0, repeat)
+            yield from bench.event(REG_SWAP, 0, 0)
+            yield from bench.idle(16)
+            yield from bench.event(REG_ENABLE, 0, 1)
+            yield from bench.idle(played + 64)
+
+        bench.run(rio(), [bench.output_monitor(0, trace)])
+        samples = [v for t, v in trace]
+        first = next(i for i, v in enumerate(samples) if v != 0)
+        samples = samples[first:first + played + 16]
+        # Repetitions back to back, then the last sample held
+        expected = loop*repeat
+        expected += [expected[-1]]*(len(samples) - len(expected))
+        ok &= samples == expected
+    return {"cases": len(cases)}, ok
+
+
+def bench_commands(n_samples, n_events=64, **options):
+    bench = _Bench(n_samples, **options)
+    enable = []
+
+    @passive
+    def monitor():
+        while True:
+            enable.append((yield bench.dut.channels[1].enable))
+            yield
+
+    def rio():
+        for i in range(n_events):
+            yield from bench.event(REG_ENABLE, 1, (i + 1) % 2, hold=False)
+        yield from bench.idle(64)
+        yield from bench.event(REG_STATUS, 0, 1)
+        yield from bench.idle(4)
+
+    bench.run(rio(), [monitor()])
+    toggles = sum(a != b for a, b in zip(enable, enable[1:]))
+    overflow = bench.replies[-1] & 1
+    # Events are either all applied or dropped with the overflow flagged
+    return ({"events": n_events, "applied": toggles, "overflow": overflow},
+            toggles == n_events if not overflow else toggles < n_events)
+
+
+def bench_trigger(n_samples, **options):
+    bench = _Bench(n_samples, **options)
+    n_dacs = bench.n_dacs
+    mu = _ramp(n_samples)
+    traces = [[] for _ in range(n_dacs)]
+    mask = 2**n_dacs - 1
+    events = []
+
+    def rio():
+        for dac in range(n_dacs):
+            yield from bench.upload(dac, mu)
+            yield from bench.event(REG_SWAP, dac, 0)
+        # Start, restart while playing, stop
+        for data in [mask, mask, mask << 8]:
+            yield from bench.idle(24)
+            events.append(bench.rio_time(bench.rio_cycle))
+            yield from bench.event(REG_TRIGGER, 0, data)
+        yield from bench.idle(24)
+
+    bench.run(rio(), [bench.output_monitor(dac, trace)
+                      for dac, trace in enumerate(traces)])
+    # First output after each trigger: the first sample, the first
+    # sample again, 0
+    first = []
+    for trace in traces:
+        first.append([
+            next((t for t, v in trace if t > event and test(v)), None)
+            for event, test in zip(events, [lambda v: v != 0,
+                                            lambda v: v == mu[0],
+                                            lambda v: v == 0])])
+    if None in first[0]:
+        return {}, False
+    latency = [(t - event)/bench.dac_period
+               for t, event in zip(first[0], events)]
+    ok = all(f == first[0] for f in first) and latency[0] == latency[1]
+    # Playback goes on normally after a restart
+    restarted = [v for t, v in traces[0] if t >= first[0][1]][:16]
+    ok &= restarted == mu[:16]
+    return {
+        "start dac cycles": latency[0],
+        "restart": latency[1],
+        "stop": latency[2],
+    }, ok
+
+
+def bench_playlist(n_samples, **options):
+    bench = _Bench(n_samples, **options)
+    mu = _ramp(n_samples)
+    trace = []
+    q = n_samples//4
+    # (index, start, length, repeat, next), not in table order, ending
+    # after a single sample segment
+    segments = [
+        (0, 0, 8, 2, 1),
+        (1, 2*q, 3, 3, 5),
+        (5, q, 1, 2, 2),
+        (2, n_samples - 5, 5, 1, 3),
+        (3, 3*q, 1, 1, PLAYLIST_DEPTH),
+    ]
+    expected = []
+    for index, start, length, repeat, next_index in segments:
+        expected += mu[start:start + length]*repeat
+
+    def rio():
+        yield from bench.upload(0, mu)
+        yield from bench.event(REG_SWAP, 0, 0)
+        for index, start, length, repeat, next_index in segments:
+            yield from bench.event(REG_SEGMENT, 0,
+                                   index << 56 | next_index << 48 |
+                                   repeat << 32 | length << 16 | start)
+        yield from bench.event(REG_PLAYLIST, 0, 1 << 8 | 0)
+        yield from bench.idle(16)
+        yield from bench.event(REG_ENABLE, 0, 1)
+        yield from bench.idle(len(expected) + 64)
+
+    bench.run(rio(), [bench.output_monitor(0, trace)])
+    samples = [v for t, v in trace]
+    first = next(i for i, v in enumerate(samples) if v != 0)
+    samples = samples[first:first + len(expected) + 16]
+    expected += [expected[-1]]*(len(samples) - len(expected))
+    return {"segments": len(segments)}, samples == expected
+
+
+def bench_banks(n_samples, n_banks=4, length=16, **options):
+    bench = _Bench(n_samples, n_banks=n_banks, **options)
+    waveforms = {
+        1: _ramp(n_samples),
+        2: [v + 2*length for v in _ramp(n_samples)]
+    }
+    trace = []
+
+    def rio():
+        for bank, mu in waveforms.items():
+            yield from bench.event(REG_WRITE_BANK, 0, bank)
+            yield from bench.upload(0, mu)
+        yield from bench.event(REG_LENGTH, 0, length)
+        yield from bench.event(REG_BANK, 0, 1)
+        yield from bench.idle(16)
+        yield from bench.event(REG_ENABLE, 0, 1)
+        # Selects land in the middle of a loop
+        for bank in [2, 1]:
+            yield from bench.idle(3*length)
+            yield from bench.event(REG_BANK, 0, bank)
+        yield from bench.idle(3*length)
+
+    bench.run(rio(), [bench.output_monitor(0, trace)])
+    samples = [v for t, v in trace]
+    first = next(i for i, v in enumerate(samples) if v != 0)
+    loops = [samples[i:i + length]
+             for i in range(first, len(samples) - length, length)]
+    # Whole loops of one bank, switching from 1 to 2 and back
+    played = [next((bank for bank, mu in waveforms.items()
+                    if loop == mu[:length]), None) for loop in loops]
+    switches = [bank for i, bank in enumerate(played)
+                if i == 0 or bank != played[i - 1]]
+    return {"banks": n_banks, "loops": len(loops)}, switches == [1, 2, 1]
+
+
+def bench_ddr(n_samples, **options):
+    bench = _Bench(n_samples, ddr=True, **options)
+    mu = _ramp(n_samples)
+    trace = []
+    # Loop of 2*q samples from q, repeated, in q dac cycles each
+    q = n_samples//4
+    loop = mu[q:3*q]
+    repeat = 3
+    played = len(loop)*repeat
+    dclkio = [[], []]
+
+    def rio():
+        yield from bench.upload(0, mu)
+        yield from bench.event(REG_MODE, 0, MODE_TABLE | MODE_DDR)
+        yield from bench.event(REG_START, 0, q)
+        yield from bench.event(REG_LENGTH, 0, 2*q)
+        yield from bench.event(REG_REPEAT, 0, repeat)
+        yield from bench.event(REG_SWAP, 0, 0)
+        yield from bench.idle(16)
+        yield from bench.event(REG_ENABLE, 0, 1)
+        yield from bench.idle(played//2 + 64)
+
+    bench.run(rio(), [bench.output_monitor(0, trace, ddr=True)],
+              [bench.dclkio_monitor(dac, dclkio[dac]) for dac in range(2)])
+    # DCLKIO rises half way through the dac cycle, then a quarter of the
+    # way through on DAC 0 in MODE_DDR. DAC 1 stays single rate.
+    def single(trace):
+        return all(level == (q >= 2) for q, level in trace)
+
+    def double(trace):
+        return all(level == (q in (1, 2)) for q, level in trace)
+
+    clock_ok = (single(dclkio[0][:16]) and double(dclkio[0][-16:]) and
+                single(dclkio[1]))
+    samples = [v for t, v in trace]
+    first = next(i for i, v in enumerate(samples) if v != 0)
+    t0 = trace[first][0]
+    samples = samples[first:first + played + 16]
+    expected = loop*repeat
+    expected += [expected[-1]]*(len(samples) - len(expected))
+    duration = (trace[first + played][0] - t0)/bench.dac_period
+    return {
+        "samples": played,
+        "dac cycles": duration,
+        "MS/s": 1e3*played/(duration*bench.dac_period),
+        "dclkio 90 deg": clock_ok,
+    }, samples == expected and clock_ok
+
+
+def bench_gain(n_samples, length=16, **options):
+    bench = _Bench(n_samples, **options)
+    full_scale = 2**DAC_DATA_WIDTH - 1
+    midscale = 2**(DAC_DATA_WIDTH - 1)
+    # Full range, both ends included
+    mu = [i*full_scale//(length - 1) for i in range(length)]
+    mu += [0]*(n_samples - length)
+    one = 1 << GAIN_FRAC_WIDTH
+    settings = [
+        (one, 0),
+        (one//2, 100),
+        (-one, -1),
+        (2*one - 1, -3000),         # saturates at both ends
+        (one//3, 5000),
+    ]
+    trace = []
+    changes = []
+
+    def rio():
+        yield from bench.upload(0, mu)
+        yield from bench.event(REG_LENGTH, 0, length)
+        yield from bench.event(REG_SWAP, 0, 0)
+        yield from bench.event(REG_ENABLE, 0, 1)
+        for gain, offset in settings:
+            yield from bench.event(REG_GAIN, 0, gain)
+            yield from bench.event(REG_OFFSET, 0, offset)
+            changes.append(bench.rio_time(bench.rio_cycle))
+            yield from bench.idle(3*length)
+
+    bench.run(rio(), [bench.output_monitor(0, trace)])
+    ok = True
+    for t, (gain, offset) in zip(changes, settings):
+        # One whole loop once the new values are through
+        window = [v for tv, v in trace if tv > t + length*bench.dac_period]
+        expected = [min(max(midscale + ((v - midscale)*gain >>
+                                        GAIN_FRAC_WIDTH) + offset, 0),
+                        full_scale)
+                    for v in mu[:length]]
+        ok &= sorted(window[:length]) == sorted(expected)
+    return {"settings": len(settings)}, ok
+
+
+def bench_stream(n_samples, **options):
+    bench = _Bench(n_samples, stream=True, **options)
+    n_dacs = bench.n_dacs
+    ports = len(bench.buses)
+    steps = SDRAM_WIDTH//STREAM_LANE_WIDTH//n_dacs
+    # Up to STREAM_SAMPLES per DAC, the simulation is slow, but at least a
+    # full prefetch and two rounds of reads over the ports
+    n_samples = max(min(n_samples, STREAM_SAMPLES),
+                    (STREAM_FIFO_DEPTH + 2*ports)*steps)
+    lanes = _ramp(n_samples*n_dacs)
+    words = len(lanes)*STREAM_LANE_WIDTH//SDRAM_WIDTH
+    # Played at the fastest rate the model sustains, a read completing
+    # every sdram_latency + 3 sys cycles on each port
+    read_time = (bench.sdram_latency + 3)*SYS_PERIOD/ports
+    divider = int(-(-read_time//(steps*bench.dac_period)))
+    traces = [[] for _ in range(n_dacs)]
+    status = []
+
+    def poll(expected, limit=1024):
+        # Stream status until it reads `expected`
+        for _ in range(limit):
+            n = len(bench.replies)
+            yield from bench.event(REG_STREAM_STATUS, 0, 0)
+            yield from bench.idle(4)
+            if bench.replies[n:] == [expected]:
+                status.append(expected)
+                return
+
+    def rio():
+        yield from bench.event(REG_STREAM_WRITE, 0, 0)
+        for i in range(0, len(lanes), 4):
+            word = 0
+            for j in range(4):
+                word |= lanes[i + j] << j*STREAM_LANE_WIDTH
+            # Faster than the kernel CPU issues them
+            yield from bench.event(REG_STREAM_DATA, 0, word)
+            yield from bench.idle(7)
+        for dac in range(n_dacs):
+            yield from bench.event(REG_MODE, dac, MODE_STREAM)
+            yield from bench.event(REG_ENABLE, dac, 1)
+        yield from bench.event(REG_STREAM_READ, 0, words << 32)
+        yield from bench.event(REG_STREAM_RUN, 0, divider << 16 | 1)
+        # Playing, then done without an underrun
+        yield from poll(1)
+        yield from poll(0)
+        yield from bench.event(REG_STATUS, 0, 1)
+        yield from bench.idle(16)
+
+    bench.run(rio(), [bench.output_monitor(dac, trace)
+                      for dac, trace in enumerate(traces)])
+    # No stream event dropped
+    overflow = bench.replies[-1] >> 1 & 1
+    ok = status == [1, 0] and not overflow
+    for dac, trace in enumerate(traces):
+        samples = [v for t, v in trace]
+        first = next((i for i, v in enumerate(samples) if v != 0), None)
+        if first is None:
+            return {"words": words}, False
+        samples = samples[first:first + n_samples*divider + 16]
+        expected = [v for v in lanes[dac::n_dacs] for _ in range(divider)]
+        expected += [expected[-1]]*(len(samples) - len(expected))
+        ok &= samples == expected
+    # Prefetch reads are back to back on each port, limited by the SDRAM
+    # latency only. Whole rounds over the ports, as they complete together.
+    reads = sorted(bench.sdram_reads)
+    rounds = (min(len(reads), STREAM_FIFO_DEPTH + ports) - 1)//ports
+    per_word = (reads[rounds*ports] - reads[0])/(rounds*ports)
+    rate = SDRAM_WIDTH//STREAM_LANE_WIDTH/(per_word*SYS_PERIOD)*1e3
+    return {
+        "words": words,
+        "overflow": overflow,
+        "divider": divider,
+        "sys cycles/word": per_word,
+        "MS/s": rate,
+        "8 DACs MS/s": rate/8,
+        # Smallest stream_play divider the read rate sustains with 8 DACs
+        "8 DACs divider": -(-per_word*SYS_PERIOD//(
+            SDRAM_WIDTH//STREAM_LANE_WIDTH//8*bench.dac_period)),
+    }, ok
+
+
+BENCHMARKS = [
+    ("upload", bench_upload),
+    ("latency", bench_latency),
+    ("loop", bench_loop),
+    ("commands", bench_commands),
+    ("trigger", bench_trigger),
+    ("playlist", bench_playlist),
+    ("banks", bench_banks),
+    ("ddr", bench_ddr),
+    ("gain", bench_gain),
+    ("stream", bench_stream),
+]
+
+
+def _format(metrics):
+    return ", ".join(
+        "{} {:.3g}".format(k, v) if isinstance(v, float) else
+        "{} {}".format(k, v)
+        for k, v in metrics.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="ShuttlerSamples simulation benchmarks")
+    parser.add_argument("--depths", type=int, nargs="+",
+                        default=[64, 256, 1024],
+                        help="storage depths (samples per bank) to test")
+    parser.add_argument("--dacs", type=int, default=2,
+                        help="number of DAC channels (default: %(default)s)")
+    parser.add_argument("--dac-period", type=int, default=DAC_PERIOD,
+                        help="dac clock period in ns (default: %(default)s)")
+    parser.add_argument("--dac-phase", type=int, default=DAC_PHASE,
+                        help="dac clock phase in ns (default: %(default)s)")
+    parser.add_argument("--sdram-latency", type=int, default=SDRAM_LATENCY,
+                        help="SDRAM model latency in sys cycles "
+                             "(default: %(default)s)")
+    parser.add_argument("--stream-ports", type=int, default=STREAM_PORTS,
+                        help="native SDRAM ports of the stream "
+                             "(default: %(default)s)")
+    parser.add_argument("--only", choices=[name for name, _ in BENCHMARKS],
+                        nargs="+", help="run only these benchmarks")
+    args = parser.parse_args()
+
+    failed = 0
+    for n_samples in args.depths:
+        for name, bench in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            t = time.monotonic()
+            metrics, ok = bench(n_samples, n_dacs=args.dacs,
+                                dac_period=args.dac_period,
+                                dac_phase=args.dac_phase,
+                                sdram_latency=args.sdram_latency,
+                                stream_ports=args.stream_ports)
+            failed += not ok
+            print("{:5d} {:9s} {:4s} {} ({:.1f} s)".format(
+                n_samples, name, "ok" if ok else "FAIL", _format(metrics),
+                time.monotonic() - t))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
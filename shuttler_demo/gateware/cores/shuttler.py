@@ -1,3 +1,7 @@
+from functools import reduce
+from operator import or_, xor
+from math import sin, pi
+
 from migen.build.generic_platform import *
 # from shuttler_demo.gateware.cores import _fmc_pin
 from migen import *
@@ -7,6 +11,9 @@ from artiq.gateware import rtio
 from artiq.gateware.rtio.phy import ttl_simple
 from artiq.gateware.rtio import rtlink
 from migen.genlib.io import DifferentialInput, DDROutput
+from migen.genlib.cdc import MultiReg, PulseSynchronizer
+from migen.genlib.fifo import AsyncFIFO
+from migen.genlib.record import Record, layout_len
 
 
 def _fmc_pin(fmc: str, bank: str, i: int, pol: str):
@@ -25,101 +32,1233 @@ def _fmc_pin(fmc: str, bank: str, i: int, pol: str):
         return pin_name_tmp.format(fmc=fmc, bank=bank, i=i, pol=pol)
 
 
-class ShuttlerSamples(Module):
+# RTLINK ADDRESS: | REG [7:3] | DAC [2:0] |. REG_TRIGGER, REG_STATUS and the
+# stream registers ignore DAC. Data layouts below; the registers are described
+# in the "Register map" section of README.md.
+REG_SAMPLE = 0              # ADDR [31:14] | SAMPLE [13:0]
+REG_ENABLE = 1              # ENABLE [0]
+REG_SAMPLES_PACKED = 2      # OFFSET [63:56] | S3 | S2 | S1 | S0 [13:0]
+REG_WRITE_BASE = 3          # ADDR [31:0], multiple of 4
+REG_SWAP = 4                # ignored
+REG_START = 5               # START [31:0]
+REG_LENGTH = 6              # LENGTH [31:0], 0 = whole bank
+REG_REPEAT = 7              # REPEAT [31:0], 0 = forever
+REG_MODE = 8                # DDR [2] | MODE [1:0]
+REG_NCO_FTW = 9             # FTW [31:0], f = FTW*f_dac/2**32
+REG_NCO_POW = 10            # POW [15:0], turns = POW/2**16
+REG_NCO_ASF = 11            # ASF [13:0]
+REG_SPLINE0 = 12            # DIFFERENCE [63:0], SPLINE_FRAC_WIDTH
+REG_SPLINE1 = 13
+REG_SPLINE2 = 14
+REG_SPLINE3 = 15
+REG_SPLINE_DURATION = 16    # DURATION [31:0], dac cycles
+REG_CHECKSUM = 17           # CLEAR [0] -> CRC-32
+REG_READBACK = 18           # ADDR [31:14] -> SAMPLE
+REG_STREAM_WRITE = 19       # WORD [31:0]
+REG_STREAM_DATA = 20        # S3 [63:48] | S2 | S1 | S0 [15:0]
+REG_STREAM_READ = 21        # LENGTH [63:32] | WORD [31:0]
+REG_STREAM_RUN = 22         # DIVIDER [31:16] | RUN [0]
+REG_STREAM_STATUS = 23      # ignored -> UNDERRUN [1] | PLAYING [0]
+REG_TRIGGER = 24            # STOP MASK [15:8] | START MASK [7:0]
+REG_SEGMENT = 25            # INDEX [63:56] | NEXT [55:48] | REPEAT [47:32]
+                            # | LENGTH [31:16] | START [15:0]
+REG_PLAYLIST = 26           # ON [8] | FIRST [7:0]
+REG_BANK = 27               # BANK [31:0]
+REG_WRITE_BANK = 28         # BANK [31:0]
+REG_GAIN = 29               # GAIN [17:0], GAIN_FRAC_WIDTH
+REG_OFFSET = 30             # OFFSET [15:0]
+REG_STATUS = 31             # CLEAR [0] -> overflows STREAM [1] | COMMAND [0]
 
-    def __init__(self, target, fmc, dac_awg_reset):
+MODE_TABLE = 0
+MODE_NCO = 1
+MODE_SPLINE = 2
+MODE_STREAM = 3
+MODE_DDR = 4
 
-        dac_data_width  = 14
-        addr_extension = 2
-        enable_extension = 1
-        rtlink_data_width = dac_data_width + addr_extension + enable_extension
-        address_width   = 8
-        # n_samples = 2^11 = 2048
-        # n_samples = 2**((rtlink_data_width - dac_data_width - 1) + address_width)
-        n_samples = 1024
+DAC_DATA_WIDTH = 14
+RTLINK_DATA_WIDTH = 64
+SAMPLE_LANES = 4
+STREAM_LANE_WIDTH = 16
+SPLINE_FRAC_WIDTH = 48
+GAIN_WIDTH = 18
+GAIN_FRAC_WIDTH = 16
+OFFSET_WIDTH = 16
+# Pipeline stages of the gain and offset stage, in dac cycles
+SCALER_LATENCY = 3
+PACKED_OFFSET_WIDTH = RTLINK_DATA_WIDTH - SAMPLE_LANES*DAC_DATA_WIDTH
+# Whole dac cycles from a REG_TRIGGER event to the first sample at the DAC
+# output register, gain and offset included (python -m
+# shuttler_demo.gateware.bench --only trigger)
+TRIGGER_LATENCY = 9
+# Playlist entries per DAC and the REG_SEGMENT word they hold
+PLAYLIST_DEPTH = 64
+SEGMENT_WIDTH = 56
+# Reflected CRC-32 polynomial (zlib, Ethernet)
+CRC32_POLY = 0xEDB88320
+
+
+# Control events crossing from rio_phy into the dac domain
+cmd_layout = [
+    ("reg", 5),
+    ("dac", 3),
+    ("data", RTLINK_DATA_WIDTH),
+]
+
+STREAM_REGS = [REG_STREAM_WRITE, REG_STREAM_DATA, REG_STREAM_READ,
+               REG_STREAM_RUN]
 
-        # RTLINK DATA:
-        # | ENABLE  |   ADDR_LOW_WORD | ACTUAL DAC WORD |
-        # |    17   |       16:14      |     13:0        |
+# Register groups: memory writes are done in rio_phy, CONTROL_REGS go to
+# the dac domain through the command FIFO, STATUS_REGS are input requests
+# and STREAM_REGS go to the SDRAM stream
+CONTROL_REGS = [REG_ENABLE, REG_SWAP, REG_START, REG_LENGTH, REG_REPEAT,
+                REG_MODE, REG_NCO_FTW, REG_NCO_POW, REG_NCO_ASF,
+                REG_SPLINE0, REG_SPLINE1, REG_SPLINE2, REG_SPLINE3,
+                REG_SPLINE_DURATION, REG_PLAYLIST, REG_BANK, REG_GAIN,
+                REG_OFFSET]
+STATUS_REGS = [REG_CHECKSUM, REG_READBACK, REG_STREAM_STATUS, REG_STATUS]
 
-        # INTERNAL ADDRESS
-        # | RTLINK_ADDR [7:0] | RTLINK_DATA [16:14]
+
+class ShuttlerCRC(Module):
+    """Parallel CRC-32 update.
+
+    `next` is the CRC state after shifting in all `data_width` bits of
+    `data`, LSB first, from state `last`. Combinational, with the same bit
+    ordering as zlib: starting from `0xFFFFFFFF`, the inverted state is
+    `zlib.crc32` of the little-endian data words.
+    """
+    def __init__(self, data_width):
+        self.last = Signal(32)
+        self.data = Signal(data_width)
+        self.next = Signal(32)
+
+        ###
+
+        # Run the bitwise algorithm symbolically: each state bit is a mask
+        # over the bits of `last` (0..31) and `data` (32..) XORed into it.
+        state = [1 << i for i in range(32)]
+        for j in range(data_width):
+            feedback = state[0] ^ (1 << (32 + j))
+            state = state[1:] + [0]
+            state = [b ^ feedback if (CRC32_POLY >> i) & 1 else b
+                     for i, b in enumerate(state)]
+        inputs = ([self.last[i] for i in range(32)] +
+                  [self.data[i] for i in range(data_width)])
+        self.comb += [
+            self.next[i].eq(reduce(xor, [bit for k, bit in enumerate(inputs)
+                                         if (taps >> k) & 1]))
+            for i, taps in enumerate(state)
+        ]
+
+
+class ShuttlerNCO(Module):
+    """Numerically controlled oscillator in the dac domain.
+
+    A 32-bit phase accumulator addresses a quarter-wave sine table, the
+    result is scaled by `asf` and centered on the DAC midscale. `out`
+    follows changes of `ftw`/`pow`/`asf` after a 5 cycle pipeline,
+    `clear` holds the accumulator at zero.
+    """
+    def __init__(self, lut_address_width=10):
+        self.ftw = Signal(32)
+        self.pow = Signal(16)
+        self.asf = Signal(DAC_DATA_WIDTH, reset=2**DAC_DATA_WIDTH - 1)
+        self.clear = Signal()
+        self.out = Signal(DAC_DATA_WIDTH)
+
+        ###
+
+        # Sampled half a step off the quadrant boundaries, so mirroring
+        # the index gives the exact samples of the next quadrant.
+        amplitude = 2**(DAC_DATA_WIDTH - 1) - 1
+        lut_depth = 2**lut_address_width
+        lut = Memory(DAC_DATA_WIDTH - 1, lut_depth, init=[
+            int(round(amplitude*sin(pi/2*(i + 0.5)/lut_depth)))
+            for i in range(lut_depth)])
+        lut_rd = lut.get_port(clock_domain="dac")
+        self.specials += lut, lut_rd
+
+        acc = Signal(32)
+        phase_full = Signal(16)
+        phase = Signal(lut_address_width + 2)
+        neg = Signal()
+        sample = Signal((DAC_DATA_WIDTH, True))
+        scaled = Signal((2*DAC_DATA_WIDTH + 1, True))
+
+        self.comb += [
+            phase_full.eq(acc[-16:] + self.pow),
+            # Second and fourth quadrants run the table backwards
+            If(phase[-2],
+                lut_rd.adr.eq(~phase[:lut_address_width])
+            ).Else(
+                lut_rd.adr.eq(phase[:lut_address_width])
+            )
+        ]
+        self.sync.dac += [
+            If(self.clear,
+                acc.eq(0)
+            ).Else(
+                acc.eq(acc + self.ftw)
+            ),
+            phase.eq(phase_full[-len(phase):]),
+            # Third and fourth quadrants are negative
+            neg.eq(phase[-1]),
+            If(neg,
+                sample.eq(-lut_rd.dat_r)
+            ).Else(
+                sample.eq(lut_rd.dat_r)
+            ),
+            scaled.eq(sample*self.asf),
+            self.out.eq(2**(DAC_DATA_WIDTH - 1) + (scaled >> DAC_DATA_WIDTH))
+        ]
+
+
+class ShuttlerScaler(Module):
+    """Gain and offset around the DAC midscale in the dac domain.
+
+    `o = midscale + (i - midscale)*gain/2**GAIN_FRAC_WIDTH + offset`,
+    rounded down and saturated to the DAC range, `SCALER_LATENCY` cycles
+    after `i`; 0 instead if `zero` was set along with `i`. Subtract,
+    multiply and add are registered in turn so that they map onto the
+    pre-adder, multiplier and post-adder of a DSP48.
+    """
+    def __init__(self):
+        self.i = Signal(DAC_DATA_WIDTH)
+        self.zero = Signal()
+        self.gain = Signal((GAIN_WIDTH, True), reset=1 << GAIN_FRAC_WIDTH)
+        self.offset = Signal((OFFSET_WIDTH, True))
+        self.o = Signal(DAC_DATA_WIDTH)
+
+        ###
+
+        midscale = 2**(DAC_DATA_WIDTH - 1)
+        full_scale = 2**DAC_DATA_WIDTH - 1
+        centered = Signal((DAC_DATA_WIDTH + 1, True))
+        product = Signal((DAC_DATA_WIDTH + GAIN_WIDTH + 1, True))
+        total = Signal((DAC_DATA_WIDTH + GAIN_WIDTH - GAIN_FRAC_WIDTH + 3,
+                        True))
+        zero = Signal(SCALER_LATENCY - 1, reset=2**(SCALER_LATENCY - 1) - 1)
+        self.comb += total.eq((product >> GAIN_FRAC_WIDTH) + self.offset +
+                              midscale)
+        self.sync.dac += [
+            centered.eq(self.i - midscale),
+            product.eq(centered*self.gain),
+            zero.eq(Cat(self.zero, zero)),
+            If(zero[-1] | (total < 0),
+                self.o.eq(0)
+            ).Elif(total > full_scale,
+                self.o.eq(full_scale)
+            ).Else(
+                self.o.eq(total)
+            )
+        ]
+
+
+class ShuttlerSpline(Module):
+    """Cubic spline generator in the dac domain.
+
+    Four accumulators in cascade (`q0 += q1`, `q1 += q2`, `q2 += q3` every
+    cycle) evaluate a cubic polynomial from its forward differences. `stb`
+    loads `coeffs` and runs the segment for `duration` cycles (sampled
+    with `stb`), `out` is the integer part of `q0` clipped to the DAC
+    range.
+    """
+    def __init__(self):
+        self.coeffs = [Signal((64, True)) for _ in range(4)]
+        self.duration = Signal(32)
+        self.stb = Signal()
+        self.out = Signal(DAC_DATA_WIDTH)
+
+        ###
+
+        q = [Signal((64, True)) for _ in range(4)]
+        remaining = Signal(32)
+        value = Signal((64 - SPLINE_FRAC_WIDTH, True))
+
+        self.comb += value.eq(q[0][SPLINE_FRAC_WIDTH:])
+        self.sync.dac += [
+            If(self.stb,
+                [qi.eq(ci) for qi, ci in zip(q, self.coeffs)],
+                remaining.eq(self.duration)
+            ).Elif(remaining != 0,
+                [q[i].eq(q[i] + q[i+1]) for i in range(3)],
+                remaining.eq(remaining - 1)
+            ),
+            If(value < 0,
+                self.out.eq(0)
+            ).Elif(value > 2**DAC_DATA_WIDTH - 1,
+                self.out.eq(2**DAC_DATA_WIDTH - 1)
+            ).Else(
+                self.out.eq(value)
+            )
+        ]
+
+
+class ShuttlerClockOut(Module):
+    """DCLKIO waveform of one DAC, in quarter dac cycles.
+
+    Drives the inputs `o1` and `o2` of an output DDR register clocked by
+    the `dac2x` domain, at twice the dac clock and in phase with it.
+    DCLKIO rises half way through the dac cycle, as an inverted dac clock,
+    and a quarter of the way through while `pair` (dac domain) is set, so
+    that its edges sit in the middle of each half cycle of double data
+    rate samples.
+    """
+    def __init__(self):
+        self.pair = Signal()
+        self.o1 = Signal()
+        self.o2 = Signal()
+
+        ###
+
+        # The dac2x cycles alternate between the first and second half of
+        # the dac cycle: toggle_2x trails toggle in the first half only
+        toggle = Signal()
+        toggle_2x = Signal()
+        pair = Signal()
+        second_next = Signal()
+        self.sync.dac += toggle.eq(~toggle)
+        self.sync.dac2x += [
+            toggle_2x.eq(toggle),
+            pair.eq(self.pair)
+        ]
+        # The inputs are registered at the next dac2x edge: quarters
+        # (0, 0), (1, 1) without pair and (0, 1), (1, 0) with it
+        self.comb += [
+            second_next.eq(toggle_2x != toggle),
+            self.o1.eq(second_next),
+            self.o2.eq(second_next ^ pair)
+        ]
+
+
+class ShuttlerStream(Module):
+    """Sample stream from SDRAM to all DACs.
+
+    `buses` are native width wishbone masters on the SDRAM, in the sys
+    domain (a single bus is accepted too), and stream words are at `base`
+    onwards on them. Register writes (`STREAM_REGS`) arrive on `cmd` in the
+    sys domain. Words are prefetched into a `fifo_depth` deep FIFO to the
+    dac domain and unpacked there into `samples`, one per DAC. `playing`
+    and `underrun` are in the dac domain.
+
+    A play is tagged with a generation bit so that words prefetched for a
+    stopped or restarted play are discarded without resetting the FIFO.
+    Each bus is a classic wishbone bus, as the native SDRAM ports of misoc,
+    with a single read in flight, so the reads are pipelined over the
+    buses: consecutive words are requested from them in turn, back to
+    back, and each bus holds its word until the previous ones are in the
+    FIFO. The sustained rate is about one word per SDRAM latency and bus.
+    Stream words are written through the first bus.
+    """
+    def __init__(self, buses, n_dacs, base=0, fifo_depth=64):
+        if not isinstance(buses, (list, tuple)):
+            buses = [buses]
+        ports = len(buses)
+        dw = len(buses[0].dat_w)
+        lanes = dw//STREAM_LANE_WIDTH
+        steps = lanes//n_dacs
+        assert steps*n_dacs*STREAM_LANE_WIDTH == dw
+        writes = dw//RTLINK_DATA_WIDTH
+
+        self.cmd = Record([("stb", 1)] + cmd_layout)
+        self.cmd_ack = Signal()
+        self.samples = [Signal(DAC_DATA_WIDTH) for _ in range(n_dacs)]
+        self.playing = Signal()
+        self.underrun = Signal()
+
+        ###
+
+        fifo = ClockDomainsRenamer({"write": "sys", "read": "dac"})(
+            AsyncFIFO(dw + 1, fifo_depth))
+        self.submodules += fifo
+
+        # sys: SDRAM writes and prefetch
+        wr_ptr = Signal(32)
+        wr_word = Signal(dw)
+        wr_count = Signal(max=max(writes, 2))
+        wr_pending = Signal()
+        writing = Signal()
+        rd_base = Signal(32)
+        rd_length = Signal(32)
+        rd_ptr = Signal(32)
+        to_request = Signal(32)
+        remaining = Signal(32)
+        fetched = Signal(max=fifo_depth + 1)
+        divider = Signal(16)
+        run = Signal()
+        starting = Signal()
+        gen = Signal()
+        ready = Signal()
+        done = Signal()
+        # Bus requesting the next word, and bus whose word goes next into
+        # the FIFO
+        issue = Signal(max=max(ports, 2))
+        turn = Signal(max=max(ports, 2))
+        push = Signal()
+
+        # Per bus: a read in flight and its word address, the read being
+        # left from a stopped play, a word completing, and the word held
+        # until its turn
+        active = [Signal() for _ in range(ports)]
+        adr = [Signal(32) for _ in range(ports)]
+        stale = [Signal() for _ in range(ports)]
+        ack = [Signal() for _ in range(ports)]
+        held = [Signal(dw) for _ in range(ports)]
+        full = [Signal() for _ in range(ports)]
+        request = [Signal() for _ in range(ports)]
+        from_bus = [Signal() for _ in range(ports)]
+        from_held = [Signal() for _ in range(ports)]
+
+        data = self.cmd.data
+        self.comb += [
+            # A word waiting for the bus holds further stream commands
+            self.cmd_ack.eq(~wr_pending),
+            done.eq(run & (remaining == 0)),
+            Case(turn, {k: [
+                fifo.din.eq(Cat(Mux(full[k], held[k], buses[k].dat_r), gen)),
+                push.eq(full[k] | ack[k])
+            ] for k in range(ports)}),
+            fifo.we.eq(push)
+        ]
+        for k, bus in enumerate(buses):
+            self.comb += [
+                bus.cyc.eq(active[k]),
+                bus.stb.eq(active[k]),
+                bus.sel.eq(2**len(bus.sel) - 1),
+                bus.adr.eq(base + adr[k]),
+                ack[k].eq(active[k] & bus.ack & ~stale[k]),
+                from_bus[k].eq(push & fifo.writable & (turn == k) & ~full[k]),
+                from_held[k].eq(push & fifo.writable & (turn == k) & full[k]),
+                # Back to back on a bus, as long as its word is out by the
+                # time the next one completes
+                request[k].eq(run & (to_request != 0) & (issue == k) &
+                              (~active[k] | bus.ack) &
+                              ((~full[k] & (~ack[k] | from_bus[k])) |
+                               from_held[k]))
+            ]
+            self.sync += [
+                If(ack[k] & ~from_bus[k],
+                    held[k].eq(bus.dat_r),
+                    full[k].eq(1)
+                ).Elif(from_held[k],
+                    full[k].eq(0)
+                ),
+                If(active[k] & bus.ack,
+                    active[k].eq(0),
+                    stale[k].eq(0)
+                ),
+                If(request[k],
+                    active[k].eq(1),
+                    adr[k].eq(rd_ptr)
+                )
+            ]
+        # Writes take the first bus between reads
+        self.comb += [
+            If(writing,
+                buses[0].cyc.eq(1),
+                buses[0].stb.eq(1),
+                buses[0].we.eq(1),
+                buses[0].adr.eq(base + wr_ptr)
+            ),
+            buses[0].dat_w.eq(wr_word)
+        ]
+        self.comb += If(wr_pending, request[0].eq(0))
+        self.sync += [
+            If(writing,
+                If(buses[0].ack,
+                    writing.eq(0),
+                    wr_pending.eq(0),
+                    wr_ptr.eq(wr_ptr + 1)
+                )
+            ).Elif(wr_pending & ~active[0],
+                writing.eq(1)
+            ),
+            If(push & fifo.writable,
+                remaining.eq(remaining - 1),
+                If(fetched != fifo_depth,
+                    fetched.eq(fetched + 1)
+                ),
+                If(turn == ports - 1,
+                    turn.eq(0)
+                ).Else(
+                    turn.eq(turn + 1)
+                )
+            ),
+            If(reduce(or_, request),
+                rd_ptr.eq(rd_ptr + 1),
+                to_request.eq(to_request - 1),
+                If(issue == ports - 1,
+                    issue.eq(0)
+                ).Else(
+                    issue.eq(issue + 1)
+                )
+            ),
+            If(starting,
+                run.eq(1),
+                starting.eq(0)
+            ),
+            If(run & (done | (fetched == fifo_depth)),
+                ready.eq(gen)
+            ),
+            If(self.cmd.stb & self.cmd_ack,
+                Case(self.cmd.reg, {
+                    REG_STREAM_WRITE: [
+                        wr_ptr.eq(data),
+                        wr_count.eq(0)
+                    ],
+                    REG_STREAM_DATA: [
+                        wr_word.eq(Cat(wr_word[RTLINK_DATA_WIDTH:], data)),
+                        If(wr_count == writes - 1,
+                            wr_count.eq(0),
+                            wr_pending.eq(1)
+                        ).Else(
+                            wr_count.eq(wr_count + 1)
+                        )
+                    ],
+                    REG_STREAM_READ: [
+                        rd_base.eq(data[:32]),
+                        rd_length.eq(data[32:])
+                    ],
+                    # Stop first, so that the dac domain never sees the
+                    # new generation running with the old one's words.
+                    # Reads in flight cannot be cancelled and are dropped
+                    # when they complete.
+                    REG_STREAM_RUN: [
+                        run.eq(0),
+                        starting.eq(data[0]),
+                        issue.eq(0),
+                        turn.eq(0),
+                        [[stale[k].eq((active[k] & ~buses[k].ack) |
+                                      request[k]),
+                          full[k].eq(0)]
+                         for k in range(ports)],
+                        If(data[0],
+                            gen.eq(~gen),
+                            divider.eq(data[16:32]),
+                            rd_ptr.eq(rd_base),
+                            to_request.eq(rd_length),
+                            remaining.eq(rd_length),
+                            fetched.eq(0)
+                        )
+                    ]
+                })
+            )
+        ]
+
+        # dac: unpacking
+        run_s = Signal()
+        gen_s = Signal()
+        ready_s = Signal()
+        done_s = Signal()
+        divider_s = Signal(16)
+        self.specials += [
+            MultiReg(run, run_s, "dac"),
+            MultiReg(gen, gen_s, "dac"),
+            MultiReg(ready, ready_s, "dac"),
+            MultiReg(done, done_s, "dac"),
+            MultiReg(divider, divider_s, "dac")
+        ]
+
+        word = Signal(dw)
+        step = Signal(max=max(steps, 2))
+        count = Signal(16)
+        play = Signal()
+        play_d = Signal()
+        tick = Signal()
+        fresh = Signal()
+        take = Signal()
+        self.comb += [
+            play.eq(run_s & (ready_s == gen_s)),
+            tick.eq(count == 0),
+            fresh.eq(fifo.readable & (fifo.dout[-1] == gen_s)),
+            take.eq(play & tick & (step == 0) & fresh),
+            # Words of an earlier generation are dropped as they come
+            fifo.re.eq(take | (fifo.readable & ~fresh))
+        ]
+
+        def unpack(source, i):
+            return [self.samples[d].eq(
+                        source[(i*n_dacs + d)*STREAM_LANE_WIDTH:][
+                            :DAC_DATA_WIDTH])
+                    for d in range(n_dacs)]
+
+        self.sync.dac += [
+            play_d.eq(play),
+            If(play & ~play_d,
+                self.underrun.eq(0)
+            ),
+            If(~play,
+                count.eq(0),
+                step.eq(0),
+                self.playing.eq(0)
+            ).Else(
+                If((count == divider_s - 1) | (divider_s == 0),
+                    count.eq(0)
+                ).Else(
+                    count.eq(count + 1)
+                ),
+                If(tick,
+                    If(step == 0,
+                        If(fresh,
+                            word.eq(fifo.dout),
+                            unpack(fifo.dout, 0),
+                            step.eq(1 % steps),
+                            self.playing.eq(1)
+                        ).Elif(done_s,
+                            self.playing.eq(0)
+                        ).Elif(self.playing,
+                            self.underrun.eq(1)
+                        )
+                    ).Else(
+                        Case(step, {i: unpack(word, i)
+                                    for i in range(1, steps)}),
+                        If(step == steps - 1,
+                            step.eq(0)
+                        ).Else(
+                            step.eq(step + 1)
+                        )
+                    )
+                )
+            )
+        ]
+
+
+class ShuttlerChannel(Module):
+    """Waveform memory and player of a single DAC.
+
+    The memory is split into `SAMPLE_LANES` interleaved lanes so that a
+    packed RTIO event can store that many consecutive samples in a single
+    cycle, and holds `n_banks` banks of `n_samples`: waveforms preloaded
+    into them are switched by selecting a bank, and one can be rewritten
+    while another plays. Samples are written through `sample_we` (one
+    bit per lane), `sample_adr` (word address) and `sample_dat` into bank
+    `sample_bank` in the rio_phy domain; `sample_dat_r` returns the word
+    at `sample_adr` one cycle later. Playlist entries are written the same
+    way through `segment_we`, `segment_adr` and `segment_dat`. Register
+    writes arrive on `cmd`, the SDRAM stream sample on `stream`, and
+    `trigger_start`/`trigger_stop` pulses, all in the dac domain.
+
+    `output` is the sample for the first half of the dac cycle, `output2`
+    for the second, after gain and offset. They differ only with `ddr` and
+    MODE_DDR set, which is flagged by `pair`.
+    """
+    def __init__(self, n_samples, n_banks=2, ddr=False):
+        sample_address_width = log2_int(n_samples)
+        lane_width = log2_int(SAMPLE_LANES)
+        word_address_width = sample_address_width - lane_width
+        bank_width = log2_int(n_banks)
+
+        self.sample_we = Signal(SAMPLE_LANES)
+        self.sample_adr = Signal(word_address_width)
+        self.sample_dat = Signal(SAMPLE_LANES*DAC_DATA_WIDTH)
+        self.sample_bank = Signal(bank_width)
+        self.sample_dat_r = Signal(SAMPLE_LANES*DAC_DATA_WIDTH)
+        self.segment_we = Signal()
+        self.segment_adr = Signal(log2_int(PLAYLIST_DEPTH))
+        self.segment_dat = Signal(SEGMENT_WIDTH)
+
+        self.cmd = Record([("stb", 1)] + cmd_layout)
+        self.restart = Signal()
+        self.stream = Signal(DAC_DATA_WIDTH)
+        self.trigger_start = Signal()
+        self.trigger_stop = Signal()
+
+        self.enable = Signal()
+        self.mode = Signal(2)
+        self.ddr = Signal()
+        self.pair = Signal()
+        self.output = Signal(DAC_DATA_WIDTH)
+        self.output2 = Signal(DAC_DATA_WIDTH)
+
+        self.submodules.nco = nco = ShuttlerNCO()
+        self.submodules.spline = spline = ShuttlerSpline()
+        self.submodules.scaler = scaler = ShuttlerScaler()
+
+        # Loop registers, picked up whenever a new loop begins
+        start = Signal(sample_address_width)
+        length = Signal(sample_address_width + 1, reset=n_samples)
+        repeat = Signal(32)
+
+        # Playlist: the segment following the current one is read
+        # asynchronously from the table, so that it is available at any
+        # wrap, even after a single sample segment. `load` takes it into
+        # the loop registers; the loop_* signals already show it then.
+        segments = Memory(SEGMENT_WIDTH, PLAYLIST_DEPTH)
+        segments_wr = segments.get_port(write_capable=True,
+                                        clock_domain="rio_phy")
+        segments_rd = segments.get_port(async_read=True, clock_domain="dac")
+        self.specials += segments, segments_wr, segments_rd
+        self.comb += [
+            segments_wr.adr.eq(self.segment_adr),
+            segments_wr.dat_w.eq(self.segment_dat),
+            segments_wr.we.eq(self.segment_we)
+        ]
+        index_width = log2_int(PLAYLIST_DEPTH)
+        playlist = Signal()
+        first = Signal(index_width)
+        next_index = Signal(index_width)
+        last = Signal()
+        load = Signal()
+        load_first = Signal()
+        advance = Signal()
+        segment = segments_rd.dat_r
+        loop_start = Signal(sample_address_width)
+        loop_length = Signal(sample_address_width + 1)
+        loop_repeat = Signal(32)
+
+        # The read port always holds the sample at `pos`. While stopped
+        # that is the loop start, so playback begins without repeating it.
+        playing = Signal()
+        done = Signal()
+        pos = Signal(sample_address_width)
+        # Samples left in the current loop after `pos`
+        cnt = Signal(sample_address_width)
+        # Loops left, 0 plays forever
+        loops = Signal(32)
+        wrap = Signal()
+        rd_adr = Signal(sample_address_width)
+        lane_sel = Signal(lane_width)
+        active_bank = Signal(bank_width)
+        pending_bank = Signal(bank_width)
+        swap_pending = Signal()
+        swap = Signal()
+        rd_bank = Signal(bank_width)
+        # Two samples per cycle: `pos` and `cnt` step by two and a loop
+        # wraps on its last pair
+        pair = Signal()
+        step = Signal(2)
+        sample = Signal(DAC_DATA_WIDTH)
+        second = Signal(DAC_DATA_WIDTH)
+        stopped = Signal(reset=1)
+        self.comb += [
+            pair.eq(self.ddr & (self.mode == MODE_TABLE)),
+            self.pair.eq(pair),
+            step.eq(Mux(pair, 2, 1)),
+            playing.eq(self.enable & ~self.restart),
+            nco.clear.eq(~playing | self.trigger_start),
+            spline.stb.eq(self.cmd.stb &
+                          (self.cmd.reg == REG_SPLINE_DURATION)),
+            spline.duration.eq(self.cmd.data),
+            wrap.eq((cnt == 0) | (pair & (cnt == 1))),
+            # From the first segment while stopped or restarted, from the
+            # next one once all loops of the current segment are done
+            load_first.eq(playlist & (~playing | self.trigger_start)),
+            advance.eq(playlist & playing & ~done & wrap & (loops == 1) &
+                       ~last),
+            load.eq(load_first | advance),
+            segments_rd.adr.eq(Mux(load_first, first, next_index)),
+            If(load,
+                loop_start.eq(segment[:16]),
+                loop_length.eq(segment[16:32]),
+                loop_repeat.eq(segment[32:48])
+            ).Else(
+                loop_start.eq(start),
+                loop_length.eq(length),
+                loop_repeat.eq(repeat)
+            ),
+            If(~playing | self.trigger_start,
+                rd_adr.eq(loop_start)
+            ).Elif(done,
+                rd_adr.eq(pos)
+            ).Elif(wrap,
+                rd_adr.eq(loop_start)
+            ).Else(
+                rd_adr.eq(pos + step)
+            ),
+            # Bank swaps only happen between two loops, so a waveform is
+            # never played half old, half new.
+            swap.eq(swap_pending &
+                    (~playing | wrap | self.trigger_start)),
+            rd_bank.eq(Mux(swap, pending_bank, active_bank))
+        ]
+
+        # Gain and offset, on the second sample too with ddr
+        self.comb += [
+            scaler.i.eq(sample),
+            scaler.zero.eq(stopped),
+            self.output.eq(scaler.o)
+        ]
+        if ddr:
+            self.submodules.scaler2 = scaler2 = ShuttlerScaler()
+            self.comb += [
+                scaler2.i.eq(Mux(pair, second, sample)),
+                scaler2.zero.eq(stopped),
+                scaler2.gain.eq(scaler.gain),
+                scaler2.offset.eq(scaler.offset),
+                self.output2.eq(scaler2.o)
+            ]
+        else:
+            self.comb += self.output2.eq(self.output)
+
+        # Waveform storage: true dual-port block RAM, written from RTIO
+        # and read by the DAC clock domain.
+        lanes_dat_r = []
+        for lane in range(SAMPLE_LANES):
+            samples = Memory(DAC_DATA_WIDTH, n_banks*n_samples//SAMPLE_LANES)
+            samples_wr = samples.get_port(write_capable=True,
+                                          clock_domain="rio_phy")
+            samples_rd = samples.get_port(clock_domain="dac")
+            self.specials += samples, samples_wr, samples_rd
+            self.comb += [
+                samples_wr.adr.eq(Cat(self.sample_adr, self.sample_bank)),
+                samples_wr.dat_w.eq(self.sample_dat[lane*DAC_DATA_WIDTH:
+                                                    (lane+1)*DAC_DATA_WIDTH]),
+                samples_wr.we.eq(self.sample_we[lane]),
+                self.sample_dat_r[lane*DAC_DATA_WIDTH:
+                                  (lane+1)*DAC_DATA_WIDTH].eq(
+                    samples_wr.dat_r),
+                samples_rd.adr.eq(Cat(rd_adr[lane_width:], rd_bank))
+            ]
+            lanes_dat_r.append(samples_rd.dat_r)
+        lanes_dat_r = Array(lanes_dat_r)
+
+        self.sync.dac += [
+            If(self.cmd.stb,
+                Case(self.cmd.reg, {
+                    REG_ENABLE: self.enable.eq(self.cmd.data[0]),
+                    REG_START: start.eq(self.cmd.data),
+                    REG_LENGTH: length.eq(self.cmd.data),
+                    REG_REPEAT: repeat.eq(self.cmd.data),
+                    REG_MODE: [
+                        self.mode.eq(self.cmd.data),
+                        self.ddr.eq(self.cmd.data[2] if ddr else 0)
+                    ],
+                    REG_NCO_FTW: nco.ftw.eq(self.cmd.data),
+                    REG_NCO_POW: nco.pow.eq(self.cmd.data),
+                    REG_NCO_ASF: nco.asf.eq(self.cmd.data),
+                    REG_SPLINE0: spline.coeffs[0].eq(self.cmd.data),
+                    REG_SPLINE1: spline.coeffs[1].eq(self.cmd.data),
+                    REG_SPLINE2: spline.coeffs[2].eq(self.cmd.data),
+                    REG_SPLINE3: spline.coeffs[3].eq(self.cmd.data),
+                    REG_GAIN: scaler.gain.eq(self.cmd.data),
+                    REG_OFFSET: scaler.offset.eq(self.cmd.data),
+                    REG_PLAYLIST: [
+                        playlist.eq(self.cmd.data[8]),
+                        first.eq(self.cmd.data)
+                    ],
+                })
+            ),
+            If(load,
+                start.eq(loop_start),
+                length.eq(loop_length),
+                repeat.eq(loop_repeat),
+                next_index.eq(segment[48:]),
+                last.eq(segment[48 + index_width:] != 0)
+            ),
+            If(self.trigger_stop,
+                self.enable.eq(0)
+            ).Elif(self.trigger_start,
+                self.enable.eq(1)
+            ),
+            active_bank.eq(rd_bank),
+            If(swap,
+                swap_pending.eq(0)
+            ),
+            If(self.cmd.stb & ((self.cmd.reg == REG_SWAP) |
+                               (self.cmd.reg == REG_BANK)),
+                pending_bank.eq(self.cmd.data),
+                swap_pending.eq(1)
+            ),
+            lane_sel.eq(rd_adr[:lane_width]),
+            stopped.eq(~playing),
+            If(~playing,
+                sample.eq(0),
+                second.eq(0),
+                pos.eq(loop_start),
+                cnt.eq(loop_length - 1),
+                loops.eq(loop_repeat),
+                done.eq(0)
+            ).Elif(self.mode == MODE_NCO,
+                sample.eq(nco.out)
+            ).Elif(self.mode == MODE_SPLINE,
+                sample.eq(spline.out)
+            ).Elif(self.mode == MODE_STREAM,
+                sample.eq(self.stream)
+            ).Elif(~done,
+                If(pair,
+                    sample.eq(lanes_dat_r[Cat(C(0, 1), lane_sel[1:])]),
+                    second.eq(lanes_dat_r[Cat(C(1, 1), lane_sel[1:])])
+                ).Else(
+                    sample.eq(lanes_dat_r[lane_sel])
+                )
+            ).Elif(pair,
+                # Only the last sample of the last pair is held
+                sample.eq(second)
+            ),
+            If(playing & ~done,
+                If(wrap,
+                    pos.eq(loop_start),
+                    cnt.eq(loop_length - 1),
+                    If(advance,
+                        loops.eq(loop_repeat)
+                    ).Else(
+                        If(loops != 0,
+                            loops.eq(loops - 1)
+                        ),
+                        # The last sample stays on the output after the
+                        # final repetition.
+                        If(loops == 1,
+                            done.eq(1)
+                        )
+                    )
+                ).Else(
+                    pos.eq(pos + step),
+                    cnt.eq(cnt - step)
+                )
+            ),
+            # A trigger restarts a playing DAC as if it had been stopped,
+            # but without zeroing the output in between
+            If(self.trigger_start,
+                pos.eq(loop_start),
+                cnt.eq(loop_length - 1),
+                loops.eq(loop_repeat),
+                done.eq(0)
+            )
+        ]
+
+
+class ShuttlerSamples(Module):
+
+    def __init__(self, target, fmc, dac_awg_reset, n_samples=1024, n_dacs=8,
+                 stream_bus=None, stream_base=0, stream_fifo_depth=64,
+                 n_banks=2, ddr=False):
+
+        address_width   = 8
+        assert log2_int(n_samples) <= 32 - DAC_DATA_WIDTH
+        # Playlist segments hold 16-bit start and length
+        assert n_samples <= 2**16
 
         self.rtlink = rtlink.Interface(
             rtlink.OInterface(
-                data_width=rtlink_data_width,
+                data_width=RTLINK_DATA_WIDTH,
                 address_width=address_width,               
                 enable_replace=False
+            ),
+            rtlink.IInterface(
+                data_width=32,
+                timestamped=False
             )
         )
-        
-        internal_address = Signal(10)     
-        self.comb += internal_address.eq(
-            Cat(self.rtlink.o.address, 
-                self.rtlink.o.data[dac_data_width+enable_extension:]))
 
-        signal_enable = Signal()
+        reg = self.rtlink.o.address[3:]
+        dac = self.rtlink.o.address[:3]
+
         clk_m2c_pads = target.platform.request(f"fmc{fmc}_clk0_m2c")
         clk_m2c = Signal()
         target.specials += [
             DifferentialInput(clk_m2c_pads.p, clk_m2c_pads.n, clk_m2c),
         ]
 
-        target.clock_domains.cd_dac = cd_dac = ClockDomain()
-        target.comb += [
-            cd_dac.clk.eq(clk_m2c),
-            cd_dac.rst.eq(dac_awg_reset)
-        ]
+        # The dac domain has no reset of its own: the command FIFO spans
+        # both domains and must not be reset on one side only. AWG reset
+        # is synchronized and restarts the channels instead.
+        target.clock_domains.cd_dac = cd_dac = ClockDomain(reset_less=True)
+        target.comb += cd_dac.clk.eq(clk_m2c)
         target.platform.add_period_constraint(clk_m2c_pads.p, 8.0)
 
-        samples = Array([Signal(dac_data_width) for x in range(n_samples)])
-        adr_ptr = Signal(max=len(samples))
+        restart = Signal()
+        self.specials += MultiReg(dac_awg_reset, restart, "dac")
 
-         
+        self.submodules.channels = channels = [
+            ShuttlerChannel(n_samples, n_banks, ddr) for _ in range(n_dacs)]
+
+        # Sample and playlist writes go straight into the channel memories
+        # (rio_phy), every other register is forwarded to the dac domain.
+        lane_width = log2_int(SAMPLE_LANES)
+        data = self.rtlink.o.data
+        single_adr = data[DAC_DATA_WIDTH:32]
+        write_base = Array(Signal(log2_int(n_samples) - lane_width)
+                           for _ in range(n_dacs))
+        packed_adr = Signal(log2_int(n_samples) - lane_width)
+        self.comb += packed_adr.eq(
+            write_base[dac] + data[-PACKED_OFFSET_WIDTH:])
+        # Channels start playing bank 0 and writing bank 1. The bank last
+        # selected for playback is tracked here so that swaps can exchange
+        # it with the write bank. Swaps and bank selects dropped by the
+        # command FIFO below are not tracked either, so that both domains
+        # agree on the banks.
+        bank_width = log2_int(n_banks)
+        write_bank = Array(Signal(bank_width, reset=1)
+                           for _ in range(n_dacs))
+        play_bank = Array(Signal(bank_width) for _ in range(n_dacs))
+        cmd_writable = Signal()
         self.sync.rio_phy += [
             If(self.rtlink.o.stb,
-                
-                samples[internal_address].eq(
-                    self.rtlink.o.data[:dac_data_width]),
-                signal_enable.eq(self.rtlink.o.data[dac_data_width])
-            ),
+                Case(reg, {
+                    REG_WRITE_BASE: write_base[dac].eq(data[lane_width:32]),
+                    REG_SWAP: If(cmd_writable,
+                        write_bank[dac].eq(play_bank[dac]),
+                        play_bank[dac].eq(write_bank[dac])
+                    ),
+                    REG_BANK: If(cmd_writable,
+                        play_bank[dac].eq(data)
+                    ),
+                    REG_WRITE_BANK: write_bank[dac].eq(data)
+                })
+            )
         ]
 
-        output = Signal(14)
-        led_counter = Signal(25)
-        target.comb += target.platform.request("user_led", 2).eq(samples[0][-1])
-        target.comb += target.platform.request("user_led", 3).eq(dac_awg_reset)
-        target.comb += target.platform.request("user_led", 4).eq(output[-1])
-        target.comb += target.platform.request("user_led", 6).eq(signal_enable)
-        target.sync.dac += [
-            If(~signal_enable,
-                output.eq(0)
+        for i, ch in enumerate(channels):
+            self.comb += [
+                If(self.rtlink.o.stb & (dac == i),
+                    If(reg == REG_SAMPLE,
+                        ch.sample_we.eq(1 << single_adr[:lane_width])
+                    ),
+                    If(reg == REG_SAMPLES_PACKED,
+                        ch.sample_we.eq(2**SAMPLE_LANES - 1)
+                    )
+                ),
+                If(reg == REG_SAMPLES_PACKED,
+                    ch.sample_adr.eq(packed_adr),
+                    ch.sample_dat.eq(data[:SAMPLE_LANES*DAC_DATA_WIDTH])
+                ).Else(
+                    ch.sample_adr.eq(single_adr[lane_width:]),
+                    ch.sample_dat.eq(Cat(*[data[:DAC_DATA_WIDTH]
+                                           for _ in range(SAMPLE_LANES)]))
+                ),
+                ch.sample_bank.eq(write_bank[i]),
+                ch.segment_we.eq(self.rtlink.o.stb & (dac == i) &
+                                 (reg == REG_SEGMENT)),
+                ch.segment_adr.eq(data[SEGMENT_WIDTH:]),
+                ch.segment_dat.eq(data[:SEGMENT_WIDTH]),
+                ch.restart.eq(restart)
+            ]
+
+        # Upload checksums: one CRC-32 state per DAC, updated by a single
+        # engine per write width since only one event arrives per cycle.
+        # Samples are zero-extended to 16 bits.
+        crc_clear = 2**32 - 1
+        crc = Array(Signal(32, reset=crc_clear) for _ in range(n_dacs))
+        crc_single = ShuttlerCRC(16)
+        crc_packed = ShuttlerCRC(SAMPLE_LANES*16)
+        self.submodules += crc_single, crc_packed
+        self.comb += [
+            crc_single.last.eq(crc[dac]),
+            crc_single.data.eq(data[:DAC_DATA_WIDTH]),
+            crc_packed.last.eq(crc[dac]),
+            crc_packed.data.eq(Cat(*[
+                Cat(data[i*DAC_DATA_WIDTH:(i+1)*DAC_DATA_WIDTH], C(0, 2))
+                for i in range(SAMPLE_LANES)]))
+        ]
+        self.sync.rio_phy += [
+            If(self.rtlink.o.stb,
+                Case(reg, {
+                    REG_SAMPLE: crc[dac].eq(crc_single.next),
+                    REG_SAMPLES_PACKED: crc[dac].eq(crc_packed.next),
+                    REG_CHECKSUM: If(data[0], crc[dac].eq(crc_clear))
+                })
+            )
+        ]
+
+        # Sticky status bits, set in rio_phy when an event is dropped
+        cmd_overflow = Signal()
+        stream_overflow = Signal()
+        status = Signal(2)
+        self.comb += status.eq(Cat(cmd_overflow, stream_overflow))
+
+        # Checksum, readback and status replies, one cycle later when the
+        # memory read port (sharing the write address) has the sample
+        stream_status = Signal(2)
+        read_stb = Signal()
+        read_checksum = Signal()
+        read_status = Signal()
+        read_card_status = Signal()
+        read_crc = Signal(32)
+        read_card = Signal(len(status))
+        read_dac = Signal(max=n_dacs)
+        read_lane = Signal(lane_width)
+        read_word = Signal(SAMPLE_LANES*DAC_DATA_WIDTH)
+        self.sync.rio_phy += [
+            read_stb.eq(self.rtlink.o.stb &
+                        reduce(or_, [reg == r for r in STATUS_REGS])),
+            read_checksum.eq(reg == REG_CHECKSUM),
+            read_status.eq(reg == REG_STREAM_STATUS),
+            read_card_status.eq(reg == REG_STATUS),
+            read_crc.eq(~crc[dac]),
+            read_card.eq(status),
+            read_dac.eq(dac),
+            read_lane.eq(single_adr[:lane_width])
+        ]
+        self.comb += [
+            read_word.eq(Array(ch.sample_dat_r for ch in channels)[read_dac]),
+            self.rtlink.i.stb.eq(read_stb),
+            If(read_checksum,
+                self.rtlink.i.data.eq(read_crc)
+            ).Elif(read_status,
+                self.rtlink.i.data.eq(stream_status)
+            ).Elif(read_card_status,
+                self.rtlink.i.data.eq(read_card)
             ).Else(
-                output.eq(samples[adr_ptr]),
-                led_counter.eq(led_counter+1),
+                self.rtlink.i.data.eq(Array(
+                    read_word[i*DAC_DATA_WIDTH:(i+1)*DAC_DATA_WIDTH]
+                    for i in range(SAMPLE_LANES))[read_lane])
+            )
+        ]
+
+        # Timestamped start/stop: a single pulse crosses into the dac
+        # domain and applies the masks, which are stable by then, to all
+        # channels at once
+        trigger_start = Signal(n_dacs)
+        trigger_stop = Signal(n_dacs)
+        self.submodules.trigger = trigger = PulseSynchronizer(
+            "rio_phy", "dac")
+        self.comb += trigger.i.eq(self.rtlink.o.stb & (reg == REG_TRIGGER))
+        self.sync.rio_phy += If(trigger.i,
+            trigger_start.eq(data[:8]),
+            trigger_stop.eq(data[8:16])
+        )
+        for i, ch in enumerate(channels):
+            self.comb += [
+                ch.trigger_start.eq(trigger.o & trigger_start[i]),
+                ch.trigger_stop.eq(trigger.o & trigger_stop[i])
+            ]
+
+        # Control registers cross into the dac domain in event order. An
+        # event finding the FIFO full is dropped and flagged in REG_STATUS.
+        cmd_fifo = ClockDomainsRenamer({"write": "rio_phy", "read": "dac"})(
+            AsyncFIFO(layout_len(cmd_layout), 16))
+        self.submodules += cmd_fifo
+        cmd_in = Record(cmd_layout)
+        cmd_out = Record(cmd_layout)
+        cmd_stb = Signal()
+        status_clear = Signal()
+        self.comb += [
+            cmd_stb.eq(self.rtlink.o.stb &
+                       reduce(or_, [reg == r for r in CONTROL_REGS])),
+            status_clear.eq(self.rtlink.o.stb & (reg == REG_STATUS) &
+                            data[0])
+        ]
+        self.sync.rio_phy += [
+            If(status_clear,
+                cmd_overflow.eq(0)
             ),
-            If(~signal_enable,
-                adr_ptr.eq(0)
-            ).Elif(adr_ptr < len(samples),
-                adr_ptr.eq(adr_ptr+1)
+            If(cmd_stb & ~cmd_fifo.writable,
+                cmd_overflow.eq(1)
+            )
+        ]
+        self.comb += [
+            cmd_in.reg.eq(reg),
+            cmd_in.dac.eq(dac),
+            # The swap command tells the dac domain which bank to play
+            If(reg == REG_SWAP,
+                cmd_in.data.eq(write_bank[dac])
             ).Else(
-                adr_ptr.eq(0)
+                cmd_in.data.eq(self.rtlink.o.data)
+            ),
+            cmd_fifo.din.eq(cmd_in.raw_bits()),
+            cmd_fifo.we.eq(cmd_stb & cmd_fifo.writable),
+            cmd_writable.eq(cmd_fifo.writable),
+            cmd_out.raw_bits().eq(cmd_fifo.dout),
+            cmd_fifo.re.eq(1)
+        ]
+        for i, ch in enumerate(channels):
+            self.comb += [
+                ch.cmd.stb.eq(cmd_fifo.readable & (cmd_out.dac == i)),
+                ch.cmd.reg.eq(cmd_out.reg),
+                ch.cmd.dac.eq(cmd_out.dac),
+                ch.cmd.data.eq(cmd_out.data)
+            ]
+
+        # SDRAM stream, run by the sys domain of the SDRAM controller, on
+        # one or more native SDRAM buses (stream_bus can be a list).
+        # Without a bus the stream registers are ignored and the status
+        # reads as 0. Stream events finding their FIFO full are dropped and
+        # flagged in REG_STATUS, as control events.
+        if stream_bus is not None:
+            self.submodules.stream = stream = ShuttlerStream(
+                stream_bus, n_dacs, stream_base, stream_fifo_depth)
+            stream_fifo = ClockDomainsRenamer(
+                {"write": "rio_phy", "read": "sys"})(
+                AsyncFIFO(layout_len(cmd_layout), 64))
+            self.submodules += stream_fifo
+            stream_out = Record(cmd_layout)
+            stream_stb = Signal()
+            self.comb += stream_stb.eq(
+                self.rtlink.o.stb &
+                reduce(or_, [reg == r for r in STREAM_REGS]))
+            self.sync.rio_phy += [
+                If(status_clear,
+                    stream_overflow.eq(0)
+                ),
+                If(stream_stb & ~stream_fifo.writable,
+                    stream_overflow.eq(1)
+                )
+            ]
+            self.comb += [
+                stream_fifo.din.eq(cmd_in.raw_bits()),
+                stream_fifo.we.eq(stream_stb & stream_fifo.writable),
+                stream_out.raw_bits().eq(stream_fifo.dout),
+                stream.cmd.stb.eq(stream_fifo.readable),
+                stream.cmd.reg.eq(stream_out.reg),
+                stream.cmd.dac.eq(stream_out.dac),
+                stream.cmd.data.eq(stream_out.data),
+                stream_fifo.re.eq(stream.cmd_ack)
+            ]
+            self.comb += [ch.stream.eq(sample)
+                          for ch, sample in zip(channels, stream.samples)]
+            self.specials += MultiReg(Cat(stream.playing, stream.underrun),
+                                      stream_status, "rio_phy")
+
+        sample0_msb = Signal()
+        self.sync.rio_phy += [
+            If(channels[0].sample_we[0] & (channels[0].sample_adr == 0),
+                sample0_msb.eq(channels[0].sample_dat[DAC_DATA_WIDTH-1])
             )
         ]
+        target.comb += target.platform.request("user_led", 2).eq(sample0_msb)
+        target.comb += target.platform.request("user_led", 3).eq(dac_awg_reset)
+        target.comb += target.platform.request("user_led", 4).eq(
+            channels[0].output[-1])
+        target.comb += target.platform.request("user_led", 6).eq(
+            channels[0].enable)
 
         tp_3 = target.platform.request(f"fmc{fmc}_tp3")
         target.specials += [
             DDROutput(0, 1, tp_3, cd_dac.clk)
         ]
 
-        for dac_id in range(8):
-            dac_pads = target.platform.request(f"fmc{fmc}_dac", dac_id)
+        # Data changes on both dac clock edges with ddr, so DCLKIO is then
+        # shifted by 90 degrees to sit in the middle of each half cycle, for
+        # DACs playing MODE_DDR only. It is generated from a clock at twice
+        # the dac clock, single rate DACs keep the inverted dac clock.
+        if ddr:
+            target.clock_domains.cd_dac2x = cd_dac2x = ClockDomain(
+                reset_less=True)
+            mmcm_fb = Signal()
+            mmcm_fb_buf = Signal()
+            dac2x = Signal()
             target.specials += [
-                DDROutput(0, 1, dac_pads.dclkio, cd_dac.clk)
+                Instance("MMCME2_BASE",
+                    p_CLKIN1_PERIOD=8.0,
+                    i_CLKIN1=clk_m2c,
+                    i_RST=0,
+                    i_PWRDWN=0,
+                    p_DIVCLK_DIVIDE=1,
+                    p_CLKFBOUT_MULT_F=8.0,
+                    o_CLKFBOUT=mmcm_fb,
+                    i_CLKFBIN=mmcm_fb_buf,
+                    p_CLKOUT0_DIVIDE_F=4.0,
+                    o_CLKOUT0=dac2x
+                ),
+                Instance("BUFG", i_I=mmcm_fb, o_O=mmcm_fb_buf),
+                Instance("BUFG", i_I=dac2x, o_O=cd_dac2x.clk)
             ]
+        self.submodules.clock_outs = clock_outs = [
+            ShuttlerClockOut() for _ in range(n_dacs if ddr else 0)]
+
+        for dac_id, ch in enumerate(channels):
+            dac_pads = target.platform.request(f"fmc{fmc}_dac", dac_id)
+            if ddr:
+                self.comb += clock_outs[dac_id].pair.eq(ch.pair)
+                target.specials += DDROutput(
+                    clock_outs[dac_id].o1, clock_outs[dac_id].o2,
+                    dac_pads.dclkio, cd_dac2x.clk)
+            else:
+                target.specials += DDROutput(0, 1, dac_pads.dclkio,
+                                             cd_dac.clk)
             for idx, dp in enumerate(dac_pads.data):
                 target.specials += [
-                    DDROutput(output[idx], output[idx], dp, cd_dac.clk)
+                    DDROutput(ch.output[idx], ch.output2[idx], dp,
+                              cd_dac.clk)
                 ]
 
 
@@ -332,7 +1471,13 @@ class Shuttler:
         ]
 
     @classmethod
-    def add_std(cls, target, fmc, iostd):
+    def add_std(cls, target, fmc, iostd, n_samples=1024, stream_base=None,
+                n_banks=2, ddr=False, stream_ports=10):
+        # stream_base: byte offset in SDRAM of the stream region, which the
+        # firmware must not use. None leaves the SDRAM stream out.
+        # stream_ports: native SDRAM ports the stream reads are pipelined
+        # over, each with one read in flight. 10 sustain all DACs at full
+        # rate with a 16-cycle SDRAM latency.
         target.platform.add_extension(cls.io(fmc, iostd))
 
         # SPI
@@ -397,6 +1542,15 @@ class Shuttler:
         target.rtio_channels.append(rtio.Channel.from_phy(phy))
 
         # ch. 10
-        phy = ShuttlerSamples(target, fmc, dac_awg_reset)
+        if stream_base is None:
+            stream_bus = None
+            stream_word = 0
+        else:
+            stream_bus = [target.get_native_sdram_if()
+                          for _ in range(stream_ports)]
+            stream_word = stream_base//(len(stream_bus[0].dat_w)//8)
+        phy = ShuttlerSamples(target, fmc, dac_awg_reset, n_samples,
+                              stream_bus=stream_bus, stream_base=stream_word,
+                              n_banks=n_banks, ddr=ddr)
         target.submodules += phy
         target.rtio_channels.append(rtio.Channel.from_phy(phy))
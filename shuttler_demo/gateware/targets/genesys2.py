@@ -12,7 +12,9 @@ from shuttler_demo.gateware.cores.shuttler import Shuttler
 
 
 class TestVariant(_StandaloneBase):
-    def __init__(self, gateware_identifier_str=None, **kwargs):
+    def __init__(self, gateware_identifier_str=None, shuttler_samples=1024,
+                 shuttler_stream_base=None, shuttler_banks=16,
+                 shuttler_ddr=False, shuttler_stream_ports=10, **kwargs):
         _StandaloneBase.__init__(
             self,
             fmc1_vadj=1.8,
@@ -24,7 +26,9 @@ class TestVariant(_StandaloneBase):
             "LA": self.platform.iostd[1.8],
             "HA": self.platform.iostd[1.8],
             "HB": self.platform.iostd[1.8]
-        })
+        }, n_samples=shuttler_samples, stream_base=shuttler_stream_base,
+            n_banks=shuttler_banks, ddr=shuttler_ddr,
+            stream_ports=shuttler_stream_ports)
 
         i2c = self.platform.request("fmc1_osc_i2c")
         self.submodules.i2c = gpio.GPIOTristate([i2c.scl, i2c.sda])
@@ -46,9 +50,37 @@ def main():
     parser.set_defaults(output_dir="artiq_genesys2")
     parser.add_argument("--gateware-identifier-str", default=None,
                         help="Override ROM identifier")
+    parser.add_argument("--shuttler-samples", default=1024, type=int,
+                        help="Waveform memory depth per Shuttler card "
+                             "(power of 2, default: %(default)s)")
+    parser.add_argument("--shuttler-banks", default=16, type=int,
+                        help="Waveform banks per DAC, each of "
+                             "--shuttler-samples samples (power of 2, "
+                             "default: %(default)s)")
+    parser.add_argument("--shuttler-ddr", action="store_true",
+                        help="Allow two samples per DAC clock cycle "
+                             "(MODE_DDR), with DCLKIO shifted by 90 degrees "
+                             "on the DACs playing it")
+    parser.add_argument("--shuttler-stream-mib", default=None, type=int,
+                        help="Enable SDRAM streaming from this offset in "
+                             "MiB into SDRAM, up to its end. The region "
+                             "must not be used by the firmware "
+                             "(default: disabled)")
+    parser.add_argument("--shuttler-stream-ports", default=10, type=int,
+                        help="Native SDRAM ports the stream reads are "
+                             "pipelined over, one read in flight on each "
+                             "(default: %(default)s)")
     args = parser.parse_args()
 
-    soc = TestVariant(gateware_identifier_str=args.gateware_identifier_str, **soc_sdram_argdict(args))
+    soc = TestVariant(gateware_identifier_str=args.gateware_identifier_str,
+                      shuttler_samples=args.shuttler_samples,
+                      shuttler_banks=args.shuttler_banks,
+                      shuttler_ddr=args.shuttler_ddr,
+                      shuttler_stream_ports=args.shuttler_stream_ports,
+                      shuttler_stream_base=(
+                          None if args.shuttler_stream_mib is None
+                          else args.shuttler_stream_mib*2**20),
+                      **soc_sdram_argdict(args))
     build_artiq_soc(soc, builder_argdict(args))
 
 
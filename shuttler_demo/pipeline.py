@@ -0,0 +1,80 @@
+"""Background preparation of Shuttler waveforms.
+
+:class:`WaveformProducer` computes waveforms ahead of playback in a thread
+or process pool, so that a kernel pulling the next buffer through an RPC
+only waits for host computation if the producer falls behind.
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from time import monotonic
+
+
+class WaveformProducer:
+    """Iterator over waveforms computed ahead of time.
+
+    Items are taken from `items` in order and mapped through `compute`;
+    up to `depth` results are being computed or waiting to be consumed at
+    any time. Results are returned in item order.
+
+    :param compute: callable mapping an item to its waveform. It must be
+        picklable if `processes` is set.
+    :param items: iterable of items, consumed lazily, so it may be
+        unbounded.
+    :param depth: number of waveforms prepared ahead.
+    :param workers: pool size, `depth` by default.
+    :param processes: use a process pool, for generators holding the GIL.
+        NumPy releases the GIL for most array operations, so the default
+        thread pool is usually enough.
+    """
+    def __init__(self, compute, items, depth=4, workers=None,
+                 processes=False):
+        if depth < 1:
+            raise ValueError("depth must be positive")
+        executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        self._pool = executor(max_workers=workers or depth)
+        self._compute = compute
+        self._items = iter(items)
+        self._pending = deque()
+        # Number of results that were not ready when requested and the
+        # total time spent waiting for them
+        self.stalls = 0
+        self.stall_time = 0.
+        for _ in range(depth):
+            self._submit()
+
+    def _submit(self):
+        try:
+            item = next(self._items)
+        except StopIteration:
+            return
+        self._pending.append(self._pool.submit(self._compute, item))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._pending:
+            raise StopIteration
+        future = self._pending.popleft()
+        self._submit()
+        if not future.done():
+            self.stalls += 1
+            t = monotonic()
+            result = future.result()
+            self.stall_time += monotonic() - t
+            return result
+        return future.result()
+
+    def close(self):
+        """Cancel waveforms not yet started and shut the pool down."""
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
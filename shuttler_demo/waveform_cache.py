@@ -0,0 +1,151 @@
+"""Persistent cache of compiled Shuttler waveforms.
+
+Entries are NumPy arrays (machine units or packed RTIO words) addressed by
+a key derived from the waveform parameters or content, see
+:func:`make_key`. Recently used entries are kept in an in-memory LRU bounded
+by size; with a directory, every entry is also stored as a `.npy` file that
+is memory-mapped on load, so a restarted experiment picks up where the last
+one stopped without regenerating anything. A cache may be shared between
+threads, e.g. the workers of a :class:`shuttler_demo.pipeline.WaveformProducer`.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Bump when the layout of cached arrays changes to invalidate old entries
+CACHE_VERSION = 1
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME",
+                          os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "shuttler_demo", "waveforms")
+
+
+def _hash_value(h, value):
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        h.update(repr((value.dtype.str, value.shape)).encode())
+        h.update(value.tobytes())
+    else:
+        h.update(repr(value).encode())
+    h.update(b"\0")
+
+
+def make_key(*args, **kwargs):
+    """Hash waveform parameters into a cache key.
+
+    Arrays contribute their dtype, shape and content, everything else its
+    `repr`, so both parametric waveforms (`make_key("sin", 1., 122e3)`) and
+    arbitrary sample arrays can be addressed.
+    """
+    h = hashlib.sha1()
+    _hash_value(h, CACHE_VERSION)
+    for value in args:
+        _hash_value(h, value)
+    for name, value in sorted(kwargs.items()):
+        _hash_value(h, name)
+        _hash_value(h, value)
+    return h.hexdigest()
+
+
+class WaveformCache:
+    """Two-level waveform cache.
+
+    :param max_bytes: bound on the total size of arrays held in memory.
+    :param directory: directory of the `.npy` store, `None` for a purely
+        in-memory cache.
+    """
+    def __init__(self, max_bytes=256*1024*1024, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def _remember(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key).nbytes
+            self._entries[key] = value
+            self._bytes += value.nbytes
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def __contains__(self, key):
+        return key in self._entries or (
+            self.directory is not None and os.path.exists(self._path(key)))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Return the cached array (read-only) or `default`."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+        if self.directory is not None:
+            try:
+                value = np.load(self._path(key), mmap_mode="r")
+            except (FileNotFoundError, ValueError):
+                pass
+            else:
+                self._remember(key, value)
+                self.disk_hits += 1
+                return value
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        """Store an array and return its read-only cached copy."""
+        value = np.array(value)
+        value.setflags(write=False)
+        if self.directory is not None:
+            # Written under a temporary name so that concurrent readers
+            # never see a partial file
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".npy")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, value)
+                os.replace(tmp, self._path(key))
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        self._remember(key, value)
+        return value
+
+    def get_or_compute(self, key, compute):
+        """Return the cached array for `key`, calling `compute()` to
+        create and store it on a miss."""
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, compute())
+        return value
+
+    def clear(self, disk=False):
+        """Drop the in-memory entries, and the `.npy` store if `disk`."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if disk and self.directory is not None:
+            for name in os.listdir(self.directory):
+                if name.endswith(".npy"):
+                    os.unlink(os.path.join(self.directory, name))
@@ -0,0 +1,157 @@
+"""Host-side waveform preparation for Shuttler.
+
+All functions work on whole NumPy arrays. Where an `out` buffer is
+accepted, the result is written there instead of allocating, so long or
+batched waveforms can be converted repeatedly without extra copies.
+Arrays of shape `(n_dacs, n_samples)` are converted for all DACs at once,
+with per-DAC calibration broadcast along the first axis.
+"""
+
+import zlib
+
+import numpy as np
+
+
+DAC_WIDTH = 14
+MU_MAX = (1 << DAC_WIDTH) - 1
+MU_MIDSCALE = 1 << (DAC_WIDTH - 1)
+# Machine units per volt (full scale is +-1 V around midscale)
+MU_PER_VOLT = MU_MIDSCALE/1.
+
+# Packed RTIO layout, see Shuttler.write_packed
+PACKED_SAMPLES = 4
+PACKED_WINDOW = 256
+# SDRAM stream layout, see Shuttler.write_stream_words: 16-bit lanes in
+# words of the SDRAM bus
+STREAM_LANE_WIDTH = 16
+STREAM_WORD_WIDTH = 256
+
+
+def _calibration(value, ndim):
+    # Per-DAC calibration vectors apply along the first axis
+    value = np.asarray(value, dtype=np.float64)
+    if value.ndim == 1 and ndim > 1:
+        value = value.reshape((-1,) + (1,)*(ndim - 1))
+    return value
+
+
+def voltage_to_mu(voltage, gain=1., offset=0., out=None):
+    """Convert voltages to DAC machine units.
+
+    The calibrated voltage `voltage*gain + offset` is scaled, rounded and
+    clipped to 0..0x3FFF. `gain` and `offset` are scalars or, for 2D input,
+    one value per DAC (row).
+
+    :param voltage: array of voltages.
+    :param gain: gain correction (dimensionless).
+    :param offset: offset correction in volts.
+    :param out: optional preallocated `int32` array of the same shape.
+    :return: `int32` array of machine units.
+    """
+    voltage = np.asarray(voltage, dtype=np.float64)
+    gain = _calibration(gain, voltage.ndim)
+    offset = _calibration(offset, voltage.ndim)
+    scaled = voltage*gain
+    scaled += offset
+    scaled *= MU_PER_VOLT
+    scaled += MU_MIDSCALE
+    np.rint(scaled, out=scaled)
+    np.clip(scaled, 0, MU_MAX, out=scaled)
+    if out is None:
+        return scaled.astype(np.int32)
+    np.copyto(out, scaled, casting="unsafe")
+    return out
+
+
+def mu_to_voltage(mu, gain=1., offset=0.):
+    """Inverse of :func:`voltage_to_mu` (up to rounding and clipping)."""
+    mu = np.asarray(mu)
+    gain = _calibration(gain, mu.ndim)
+    offset = _calibration(offset, mu.ndim)
+    return ((mu - MU_MIDSCALE)/MU_PER_VOLT - offset)/gain
+
+
+def clip_mu(mu, out=None):
+    """Clip machine units to the DAC range, as `int32`."""
+    if out is None:
+        out = np.empty(np.shape(mu), dtype=np.int32)
+    np.clip(mu, 0, MU_MAX, out=out, casting="unsafe")
+    return out
+
+
+def pack_samples(mu, out=None):
+    """Pack machine units into REG_SAMPLES_PACKED RTIO words.
+
+    Every group of four samples becomes one 64-bit word carrying the word
+    offset within its 1024-sample write window, split into `[low, high]`
+    `int32` halves as expected by `rtio_output_wide`. The result is a flat
+    `int32` array of `2*ceil(n/4)` entries per DAC, ready for
+    `Shuttler.write_packed_words`. A trailing partial group is padded with
+    its last sample.
+
+    :param mu: `(n_samples,)` or `(n_dacs, n_samples)` machine units.
+    :param out: optional preallocated `int32` array for the result.
+    """
+    mu = np.asarray(mu)
+    n = mu.shape[-1]
+    n_words = -(-n//PACKED_SAMPLES)
+    padded = n_words*PACKED_SAMPLES
+    if padded != n:
+        pad = [(0, 0)]*(mu.ndim - 1) + [(0, padded - n)]
+        mu = np.pad(mu, pad, mode="edge")
+    groups = (mu.astype(np.int64) & MU_MAX).reshape(
+        mu.shape[:-1] + (n_words, PACKED_SAMPLES))
+    words = np.arange(n_words, dtype=np.int64) % PACKED_WINDOW
+    words <<= PACKED_SAMPLES*DAC_WIDTH
+    for i in range(PACKED_SAMPLES):
+        words = words | (groups[..., i] << (i*DAC_WIDTH))
+    if out is None:
+        out = np.empty(mu.shape[:-1] + (2*n_words,), dtype=np.int32)
+    halves = out.reshape(mu.shape[:-1] + (n_words, 2))
+    halves[..., 0] = (words & 0xFFFFFFFF).astype(np.uint32).view(np.int32)
+    halves[..., 1] = (words >> 32).astype(np.int32)
+    return out
+
+
+def pack_stream(mu, n_dacs=8, word_width=STREAM_WORD_WIDTH, out=None):
+    """Pack machine units into REG_STREAM_DATA RTIO words.
+
+    Samples of all DACs are interleaved, sample `i` of DAC `d` in lane
+    `i*n_dacs + d`, four lanes per 64-bit RTIO word, split into
+    `[low, high]` `int32` halves for `Shuttler.write_stream_words`. The
+    stream is padded with its last samples to whole SDRAM words of
+    `word_width` bits; it is `len(result)*32//word_width` words long.
+
+    :param mu: `(n_dacs, n_samples)` machine units.
+    :param n_dacs: DACs of the gateware, as the stream always carries all
+        of them.
+    :param out: optional preallocated `int32` array for the result.
+    """
+    mu = np.asarray(mu)
+    if mu.ndim != 2 or mu.shape[0] != n_dacs:
+        raise ValueError("expected samples for {} DACs".format(n_dacs))
+    steps = word_width//STREAM_LANE_WIDTH//n_dacs
+    n = mu.shape[1]
+    padded = -(-n//steps)*steps
+    if padded != n:
+        mu = np.pad(mu, [(0, 0), (0, padded - n)], mode="edge")
+    lanes = (mu.T.astype(np.uint16) & MU_MAX).reshape(-1)
+    if out is None:
+        out = np.empty(len(lanes)//2, dtype=np.int32)
+    # Little-endian lanes: two per int32 half, lower lane first
+    out.view(np.uint32)[:] = lanes[0::2] | lanes[1::2].astype(
+        np.uint32) << STREAM_LANE_WIDTH
+    return out
+
+
+def checksum(mu):
+    """CRC-32 of uploaded samples, as returned by the REG_CHECKSUM register.
+
+    Samples count as little-endian 16-bit words in upload order. Uploads
+    through :func:`pack_samples` include the padding of a trailing partial
+    group, so pass the padded samples in that case.
+
+    :return: unsigned CRC-32 (`zlib.crc32`).
+    """
+    mu = np.asarray(mu).astype(np.int64) & MU_MAX
+    return zlib.crc32(mu.astype("<u2").tobytes())